@@ -0,0 +1,386 @@
+#!/usr/bin/python3
+
+# Micro-benchmarks for the Red Panda Lineage dataset scripts. Each benchmark
+# runs against the real dataset in this repository, and prints timings for
+# the old and new versions of a code path side-by-side.
+
+import contextlib
+import gc
+import git
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from manage import remove_author_from_lineage, sort_image_locators
+from sample import PhotoQueryIndex, collect_photo_uris
+from shared import *
+
+def data_file_paths(folder):
+    """List every data file underneath a dataset folder, in sorted order."""
+    paths = []
+    for root, dirs, files in os.walk(folder):
+        for filename in files:
+            paths.append(root + os.sep + filename)
+    return sorted(paths)
+
+def print_timing(label, seconds, count):
+    print("%-36s %8.3fs  %8.0f files/s" % (label, seconds, count / seconds))
+
+def benchmark_parsers(folder=PANDA_PATH, rounds=3):
+    """
+    Compare parse and write throughput of ProperlyDelimitedConfigParser and
+    SectionParser over every file in a dataset folder, and check that the
+    fast parser writes back the same bytes as the ConfigParser version.
+    """
+    paths = data_file_paths(folder)
+    section = folder.split("/")[-1].split("s")[0]   # HACK
+    results = {}
+    for parser_class in [ProperlyDelimitedConfigParser, SectionParser]:
+        parse_time = 0
+        write_time = 0
+        outputs = []
+        for _ in range(rounds):
+            outputs = []
+            for path in paths:
+                start = time.perf_counter()
+                config = parser_class(default_section=section, delimiters=(':'))
+                config.read(path, encoding="utf-8")
+                parse_time = parse_time + time.perf_counter() - start
+                buffer = io.StringIO()
+                start = time.perf_counter()
+                config.write(buffer)
+                write_time = write_time + time.perf_counter() - start
+                outputs.append(buffer.getvalue())
+        name = parser_class.__name__
+        print_timing(name + " parse", parse_time, len(paths) * rounds)
+        print_timing(name + " write", write_time, len(paths) * rounds)
+        results[name] = outputs
+    mismatches = [paths[i] for i, output in enumerate(results["SectionParser"])
+                  if output != results["ProperlyDelimitedConfigParser"][i]]
+    print("%s files, %s with differing output" % (len(paths), len(mismatches)))
+    for path in mismatches:
+        print("  " + path)
+
+class LegacyPhotoFile():
+    """
+    The ConfigParser-backed PhotoFile from before it was list-backed, kept as
+    a baseline for the benchmarks. It only has the methods they need, and
+    like the original, update_file rewrites the file whether or not anything
+    changed.
+    """
+    def __init__(self, section, file_path):
+        self.section = section
+        self.config = ProperlyDelimitedConfigParser(default_section=self.section, delimiters=(':'))
+        self.config.read(file_path, encoding="utf-8")
+        self.file_path = file_path
+
+    def has_field(self, field_name):
+        return self.config.has_option(self.section, field_name)
+
+    def get_array(self, field_name):
+        if self.has_field(field_name):
+            result = self.config.get(self.section, field_name)
+            if (result.find(", ") != -1):
+                return result.split(", ")
+            else:
+                return [result]
+        return []
+
+    def get_field(self, field_name):
+        if self.has_field(field_name):
+            return self.config.get(self.section, field_name)
+        else:
+            return None
+
+    def set_field(self, field_name, value):
+        self.config.set(self.section, field_name, value)
+
+    def copy_field(self, dest_field, source_field):
+        if self.has_field(source_field) == True:
+            self.set_field(dest_field, self.get_field(source_field))
+        return self.has_field(source_field)
+
+    def delete_field(self, field_name):
+        if self.has_field(field_name):
+            self.config.remove_option(self.section, field_name)
+
+    def move_field(self, dest_field, source_field):
+        if self.copy_field(dest_field, source_field) == True:
+            self.delete_field(source_field)
+        return self.has_field(dest_field)
+
+    def __strings_number_sensitive(self, input):
+        components = input[0].split(".")
+        output = []
+        for val in components:
+            if val.isdigit():
+                val = chr(int(val))
+            output.append(val)
+        return ".".join(output)
+
+    def update_file(self):
+        with open(self.file_path, 'w', encoding='utf-8') as wfh:
+            # Sort the sections before writing
+            self.config._defaults = OrderedDict(
+                sorted(self.config._defaults.items(), key=self.__strings_number_sensitive))
+            self.config.write(wfh)
+
+    def delete_photo(self, index):
+        photo_option = "photo." + str(index)
+        if self.has_field(photo_option) == False:
+            return False
+        author_tags = photo_option + ".tags"
+        print("deleting: " + self.file_path + " -- " + photo_option)
+        self.delete_field(photo_option)
+        self.delete_field(photo_option + ".author")
+        self.delete_field(photo_option + ".commitdate")
+        self.delete_field(photo_option + ".link")
+        self.delete_field(author_tags)
+        for panda_id in self.get_array("panda.tags"):
+            self.delete_field(author_tags + "." + panda_id + ".location")
+        return True
+
+    def photo_count(self):
+        photo_index = 1
+        while self.has_field("photo." + str(photo_index)):
+            photo_index = photo_index + 1
+        return photo_index - 1
+
+    def __fetch_next_photo_index(self, start_point, stop_point):
+        photo_index = start_point
+        is_photo = self.has_field("photo." + str(photo_index))
+        if is_photo == True:
+            # Find the first hole (slot without a photo)
+            while is_photo == True:
+                photo_index = photo_index + 1
+                is_photo = self.has_field("photo." + str(photo_index))
+                if photo_index > stop_point:
+                    return 0
+        # Now that we're in holes, find the next valid photo
+        while is_photo == False:
+            photo_index = photo_index + 1
+            is_photo = self.has_field("photo." + str(photo_index))
+            if photo_index > stop_point:
+                return 0
+        return photo_index
+
+    def renumber_photos(self, stop_point):
+        photo_index = 1
+        while photo_index <= stop_point:
+            photo_option = "photo." + str(photo_index)
+            if self.has_field(photo_option) == False:
+                next_index = self.__fetch_next_photo_index(photo_index, stop_point)
+                next_option = "photo." + str(next_index)
+                if self.has_field(next_option) == True:
+                    for field in ["", ".author", ".commitdate", ".link", ".tags"]:
+                        self.move_field(photo_option + field, next_option + field)
+                    for panda_id in self.get_array("panda.tags"):
+                        location = ".tags." + panda_id + ".location"
+                        self.move_field(photo_option + location, next_option + location)
+            photo_index = photo_index + 1
+
+    def remove_author(self, author):
+        removals = 0
+        photo_index = 1
+        author_option = "photo." + str(photo_index) + ".author"
+        while self.has_field(author_option):
+            if author == self.get_field(author_option):
+                self.delete_photo(photo_index)
+                removals = removals + 1
+            photo_index = photo_index + 1
+            author_option = "photo." + str(photo_index) + ".author"
+        if removals > 0:
+            self.renumber_photos(photo_index)
+
+def benchmark_author_removal(author):
+    """
+    Time an author-removal sweep in a scratch clone of this repository, first
+    the way it used to run (parse every data file with ConfigParser and
+    rewrite it, with one `git add` per file), and then with
+    remove_author_from_lineage, which uses the dataset index and stages
+    everything in batched git calls.
+    """
+    scratch = tempfile.mkdtemp()
+    origin = os.getcwd()
+    try:
+        repo = git.Repo(".").clone(scratch)
+        os.chdir(scratch)
+        # Build the persistent dataset index ahead of time, like a prior run would
+        load_dataset_index()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for file_path in [PANDA_PATH, ZOO_PATH, MEDIA_PATH]:
+                section = file_path.split("/")[-1].split("s")[0]   # HACK
+                for path in data_file_paths(file_path):
+                    photo_list = LegacyPhotoFile(section, path)
+                    photo_list.remove_author(author)
+                    photo_list.update_file()
+                    repo.git.add(path)
+        before = time.perf_counter() - start
+        staged = repo.git.diff("--cached", "--name-only").split()
+        repo.git.reset("--hard", "--quiet")
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            remove_author_from_lineage(author)
+        after = time.perf_counter() - start
+        committed = repo.git.diff("HEAD~1", "HEAD", "--name-only").split()
+        repo.close()
+    finally:
+        os.chdir(origin)
+        shutil.rmtree(scratch)
+    print("%-36s %8.3fs  %s files staged" % ("per-file git add sweep", before, len(staged)))
+    print("%-36s %8.3fs  %s files staged" % ("remove_author_from_lineage", after, len(committed)))
+
+def legacy_sort_image_locators(path):
+    """
+    The field-by-field cwdc:// sort that sort_image_locators replaced, kept
+    as a reference for benchmark_locator_sort. Every photo field is moved to
+    an "old." name and back in a ConfigParser-backed LegacyPhotoFile, the
+    sort key searches HASH_ORDER for every character, and used slots are
+    tracked in a list.
+    """
+    photo_list = LegacyPhotoFile("panda", path)
+    stop_point = photo_list.photo_count() + 1
+    cwdc_photos = []
+    fields = ["", ".author", ".commitdate", ".link", ".tags"]
+    for photo_index in range(1, stop_point + 1):
+        photo_option = "photo." + str(photo_index)
+        photo = photo_list.get_field(photo_option)
+        if photo == None:
+            continue
+        cwdc_photos.append([photo, photo_index])
+        for field in fields:
+            photo_list.move_field("old." + photo_option + field, photo_option + field)
+    cwdc_photos = sorted(
+        cwdc_photos,
+        key=lambda x:
+            [HASH_ORDER.index(char) for char in x[0].split("/")[-1].split(".")[0]])
+    cwdc_photos = sorted(cwdc_photos, key=lambda x: len(x[0].split("/")[-1].split(".")[0]))
+    used_indices = []
+    for list_index, [photo, old_index] in enumerate(cwdc_photos, start=1):
+        photo_index = list_index
+        while photo_index in used_indices:
+            photo_index = photo_index + 1
+        used_indices.append(photo_index)
+        for field in fields:
+            photo_list.move_field("photo." + str(photo_index) + field,
+                                  "old.photo." + str(old_index) + field)
+    photo_list.update_file()
+
+def write_synthetic_photo_file(path, photo_count):
+    """
+    Write a panda file with photo_count cwdc:// photos in random order.
+    """
+    photo_list = PhotoFile("panda", path)
+    photo_list.set_field("_id", "9999")
+    photo_list.set_field("species", "1")
+    for photo_index in range(1, photo_count + 1):
+        photo_option = "photo." + str(photo_index)
+        locator = "".join(random.choice(HASH_ORDER) for _ in range(7)) + "ADQA"
+        photo_list.set_field(photo_option, "cwdc://" + locator + ".jpg")
+        photo_list.set_field(photo_option + ".author", "author" + str(photo_index % 40))
+        photo_list.set_field(photo_option + ".commitdate", "2024/1/1")
+        photo_list.set_field(photo_option + ".link", "ig://" + locator)
+        photo_list.set_field(photo_option + ".tags", "portrait, sample")
+    photo_list.update_file()
+
+def benchmark_locator_sort(photo_count=5000):
+    """
+    Sort a synthetic panda file of cwdc:// photos with the old field-moving
+    sort and with sort_image_locators, and check both give the same file.
+    """
+    scratch = tempfile.mkdtemp()
+    try:
+        folder = os.path.join(scratch, "pandas", "synthetic", "0001_synthetic-zoo")
+        os.makedirs(folder)
+        source = os.path.join(folder, "9999_source.txt")
+        write_synthetic_photo_file(source, photo_count)
+        outputs = []
+        for label, sorter in [["legacy field-moving sort", legacy_sort_image_locators],
+                              ["sort_image_locators", sort_image_locators]]:
+            path = os.path.join(folder, "9999_" + sorter.__name__ + ".txt")
+            shutil.copy(source, path)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                sorter(path)
+            elapsed = time.perf_counter() - start
+            print("%-36s %8.3fs  %s photos" % (label, elapsed, photo_count))
+            with open(path, "r", encoding="utf-8") as rfh:
+                outputs.append(rfh.read())
+        print("sorted outputs match: %s" % (outputs[0] == outputs[1]))
+    finally:
+        shutil.rmtree(scratch)
+
+class LegacyPhotoEntry():
+    """
+    The PhotoEntry layout from before it had __slots__ and interned strings,
+    kept as a reference for benchmark_photo_entries. Each photo has its own
+    __dict__, holding whichever string objects its photo file handed out.
+    """
+    def __init__(self, photo_file, photo_index):
+        key = "photo." + str(photo_index)
+        self.filename = photo_file.file_path
+        self.author_name = photo_file.get_field(key + ".author")
+        self.commitdate = photo_file.get_field(key + ".commitdate")
+        self.entity_commitdate = photo_file.get_field("commitdate")
+        self.entity_id = photo_file.get_field("_id")
+        self.entity_type = photo_file.section
+        self.photo_index = key.split(".")[1]
+        self.photo_uri = photo_file.get_field(key)
+        self.species = photo_file.get_field("species")
+
+def build_legacy_photo_entries():
+    """
+    Build a LegacyPhotoEntry for every photo that collect_photo_uris yields
+    with its default arguments.
+    """
+    entries = []
+    query = PhotoQueryIndex(load_dataset_index())
+    for [record, photo_indexes] in query.query(None, ["1", "2"], 0):
+        photo_file = PhotoFile(record["section"], record["path"])
+        for photo_index in photo_indexes:
+            entries.append(LegacyPhotoEntry(photo_file, photo_index))
+    return entries
+
+def build_photo_entries():
+    return list(collect_photo_uris())
+
+def benchmark_photo_entries():
+    """
+    Collect every panda photo the way sampling does, through
+    collect_photo_uris, and compare it against building the old dict-based
+    entries for the same photos. tracemalloc measures how much memory the
+    entries keep alive once everything else is gone, and the peak while
+    building them.
+    """
+    for label, builder in [["legacy dict entries", build_legacy_photo_entries],
+                           ["collect_photo_uris", build_photo_entries]]:
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        entries = builder()
+        elapsed = time.perf_counter() - start
+        gc.collect()
+        [retained, peak] = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("%-36s %8.3fs  %s photos, %.1f MiB retained, %.1f MiB peak" % (
+            label, elapsed, len(entries), retained / 2 ** 20, peak / 2 ** 20))
+        del entries
+
+if __name__ == '__main__':
+    """Choose a benchmark."""
+    if len(sys.argv) == 2:
+        if sys.argv[1] == "--parsers":
+            benchmark_parsers()
+        if sys.argv[1] == "--locator-sort":
+            benchmark_locator_sort()
+        if sys.argv[1] == "--photo-entries":
+            benchmark_photo_entries()
+    if len(sys.argv) == 3:
+        if sys.argv[1] == "--author-removal":
+            benchmark_author_removal(sys.argv[2])
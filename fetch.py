@@ -0,0 +1,206 @@
+# Download Red Panda Lineage photos, for building samples of the dataset. A small
+# pool of threads shares one pooled HTTP session. Each host gets its own token-bucket
+# rate limit, so being polite to one site doesn't hold up downloads from the others.
+
+import concurrent.futures
+import os
+import random
+import requests
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from shared import normalize_photo_uri
+
+# Where cwdc:// locators are hosted, and where IG shortcodes get resolved
+CWDC_URL = "https://www.codaworry.com/images/submitted/"
+OEMBED_URL = "https://graph.facebook.com/v16.0/instagram_oembed"
+
+# Requests per second (and burst size) for each host. IG used to get a 15-30
+# second sleep after every photo, so keep the API hosts at about that pace.
+DEFAULT_RATE = [2.0, 4]
+HOST_RATES = {
+    "graph.facebook.com": [1 / 15, 1],
+    "www.instagram.com": [1 / 15, 1]
+}
+
+# Responses worth trying again, after a backoff
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+class TokenBucket():
+    """
+    Allow `rate` requests per second to one host, with bursts of up to
+    `burst` requests. Threads calling acquire() wait for a token.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class PhotoFetcher():
+    """
+    Fetch photos by their dataset URI (ig://, cwdc://, or http(s)) into local
+    files. Downloads go to a "<file>.part" file that's renamed once complete.
+    An interrupted download resumes with an HTTP range request, and files
+    that already exist are skipped, so re-running a fetch only downloads
+    what's missing. Failed requests are retried with exponential backoff.
+
+    The CWDC and oEmbed base URLs can be pointed at a local HTTP server for
+    testing.
+    """
+    def __init__(self, workers=4, token=None, retries=4, backoff=2.0, timeout=30,
+                 host_rates=HOST_RATES, cwdc_url=CWDC_URL, oembed_url=OEMBED_URL):
+        self.workers = workers
+        self.token = token
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.host_rates = host_rates
+        self.cwdc_url = cwdc_url
+        self.oembed_url = oembed_url
+        self.buckets = {}
+        self.buckets_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __bucket(self, url):
+        host = url.split("/")[2].lower()
+        with self.buckets_lock:
+            if host not in self.buckets:
+                [rate, burst] = self.host_rates.get(host, DEFAULT_RATE)
+                self.buckets[host] = TokenBucket(rate, burst)
+            return self.buckets[host]
+
+    def __request(self, url, allow=[], **kwargs):
+        """
+        GET a URL within its host's rate limit, retrying connection errors
+        and retryable statuses. Returns the response, or None on failure.
+        Error statuses in `allow` are returned for the caller to handle.
+        """
+        for attempt in range(0, self.retries + 1):
+            if attempt > 0:
+                delay = self.backoff * 2 ** (attempt - 1)
+                time.sleep(delay + random.uniform(0, delay / 2))
+            self.__bucket(url).acquire()
+            try:
+                response = self.session.get(url, timeout=self.timeout, **kwargs)
+            except requests.RequestException as e:
+                print("retrying %s: %s" % (url, e))
+                continue
+            if response.status_code in RETRY_STATUSES:
+                print("retrying %s: HTTP %s" % (url, response.status_code))
+                response.close()
+                continue
+            if response.status_code >= 400 and response.status_code not in allow:
+                print("failed %s: HTTP %s" % (url, response.status_code))
+                response.close()
+                return None
+            return response
+        return None
+
+    def resolve(self, photo_uri, size="m"):
+        """
+        Turn a dataset photo URI into a URL for the image itself. IG posts
+        are looked up through the oEmbed API, which needs an access token.
+        """
+        if photo_uri.startswith("cwdc://"):
+            return self.cwdc_url + photo_uri.split("/")[-1]
+        if photo_uri.startswith("ig://"):
+            if self.token == None:
+                print("no OE_TOKEN to look up %s" % photo_uri)
+                return None
+            shortcode = normalize_photo_uri(photo_uri).split("/")[2]
+            response = self.__request(self.oembed_url, params={
+                "url": "https://www.instagram.com/p/" + shortcode + "/",
+                "fields": "thumbnail_url",
+                "maxwidth": {"t": 150, "m": 320, "l": 1080}.get(size, 320),
+                "access_token": self.token
+            })
+            if response == None:
+                return None
+            try:
+                return response.json()["thumbnail_url"]
+            except (ValueError, KeyError):
+                print("no thumbnail for %s" % photo_uri)
+                return None
+        return photo_uri
+
+    def fetch(self, photo_uri, output_path, size="m"):
+        """
+        Download one photo to output_path. Returns True if the file is
+        there when we're done, whether or not it was downloaded just now.
+        """
+        if os.path.exists(output_path):
+            return True
+        url = self.resolve(photo_uri, size)
+        if url == None:
+            return False
+        part_path = output_path + ".part"
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": "bytes=%s-" % offset} if offset > 0 else {}
+        response = self.__request(url, allow=[416], headers=headers, stream=True)
+        if response == None:
+            return False
+        if response.status_code == 416:
+            # The range starts past the end of the file. If the server's total
+            # size (from "bytes */<size>") matches, the .part was already done
+            total = response.headers.get("Content-Range", "").split("/")[-1]
+            response.close()
+            if total == str(offset):
+                os.replace(part_path, output_path)
+                print("fetched: %s" % output_path)
+                return True
+            # Otherwise the .part is bad, so start over without a range
+            os.remove(part_path)
+            response = self.__request(url, stream=True)
+            if response == None:
+                return False
+        # Servers that ignore the range request send the whole file again
+        mode = "ab" if response.status_code == 206 else "wb"
+        try:
+            with open(part_path, mode) as wfh:
+                for chunk in response.iter_content(chunk_size=65536):
+                    wfh.write(chunk)
+        except requests.RequestException as e:
+            # Keep the partial file, and pick up from there next time
+            print("interrupted %s: %s" % (url, e))
+            return False
+        finally:
+            response.close()
+        os.replace(part_path, output_path)
+        print("fetched: %s" % output_path)
+        return True
+
+    def fetch_all(self, downloads):
+        """
+        Fetch a list of [photo_uri, output_path, size] downloads on the
+        thread pool. Returns the downloads that failed.
+        """
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.fetch, *download): download
+                       for download in downloads}
+            for future in concurrent.futures.as_completed(futures):
+                if future.result() == False:
+                    failed.append(futures[future])
+        return failed
+
+    def close(self):
+        self.session.close()
@@ -4,81 +4,277 @@
 # revisions, such as ensuring that a field exists in each panda or zoo file, or removing
 # photos taken by a specific credited author.
 
+import concurrent.futures
 import git
+import json
 import os
 import re
+import subprocess
 import sys
 
-from shared import HASH_ORDER, MEDIA_PATH, PANDA_PATH, ZOO_PATH, CommitError, PhotoFile, datetime_to_unixtime, get_max_entity_count, read_settings, update_ig_link
+from collections import OrderedDict
+from shared import CommitError, GitStager, PhotoFile, datetimes_to_unixtimes, hash_locator_key, load_dataset_index, normalize_photo_uri, read_settings, update_ig_link
 from unidiff import PatchSet
 
-def find_commit_of_removed_photos(author, repo):
-    """
-    Iterate through the Git repo and find the most recent commit where an 
-    author's photos were removed.
-    """
-    counter = 0
-    compare = repo.commit("HEAD")
-    for commit in repo.iter_commits('master'):
-        diff_raw = repo.git.diff(compare, 
-                                 commit,
-                                 ignore_blank_lines=True,
-                                 ignore_space_at_eol=True)
-        patch = PatchSet(diff_raw)
-        for change in patch:
-            filename = change.path
-            if filename.find(".txt") == -1:
-                # Don't care about non-data files
-                continue
-            elif change.removed <= 0:
-                # No lines were removed, so we don't care
+# Append-only history of which commits removed which authors' photos
+AUTHOR_REMOVALS_PATH = "./export/author-removals.jsonl"
+
+class AuthorRemovalIndex():
+    """
+    Tracks the photos each author-removal commit ("-author: <name>", made by
+    remove_author_from_lineage) took out of the data files, so that restoring
+    an author's photos doesn't need a history search. Other commits that drop
+    photos, like ig:// to cwdc:// swaps or photo deletions, aren't removals
+    of an author and are never indexed. Each line of the index file is a
+    JSON object, either a removal:
+
+        {"type": "removal", "author": ..., "commit": ..., "path": ...,
+         "photos": {"photo.4": ..., "photo.4.author": ..., ...}}
+
+    a note that a removal has since been restored:
+
+        {"type": "restored", "author": ..., "commit": ...}
+
+    or a marker saying which commit the index has been brought up to. New
+    history is only ever appended, starting from the last marker.
+    """
+    VERSION = 1
+
+    def __init__(self, repo, index_path=AUTHOR_REMOVALS_PATH):
+        self.repo = repo
+        self.index_path = index_path
+        self.indexed_commit = None
+        self.removals = {}
+        self.restored = set()   # (author, commit)
+        self.__load()
+
+    def __load(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "r", encoding="utf-8") as rfh:
+            for line in rfh:
+                entry = json.loads(line)
+                if entry["type"] == "indexed":
+                    self.indexed_commit = entry["commit"]
+                elif entry["type"] == "restored":
+                    self.restored.add((entry["author"], entry["commit"]))
+                else:
+                    self.removals.setdefault(entry["author"], []).append(entry)
+
+    def __append(self, entries, head):
+        """Write entries and a marker for the commit they're indexed up to"""
+        folder = os.path.dirname(self.index_path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        mode = "a" if self.indexed_commit != None else "w"
+        with open(self.index_path, mode, encoding="utf-8") as wfh:
+            for entry in entries:
+                wfh.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                self.removals.setdefault(entry["author"], []).append(entry)
+            wfh.write(json.dumps({"type": "indexed", "commit": head,
+                                  "version": self.VERSION}) + "\n")
+        self.indexed_commit = head
+
+    def __removal_author(self, commit):
+        """The author an author-removal commit was for, or None"""
+        summary = self.repo.commit(commit).summary
+        if summary.find("-author: ") != 0:
+            return None
+        return summary[len("-author: "):]
+
+    def __removed_photos(self, patches):
+        """
+        Given (commit, author, path, removed lines, added lines) for files
+        changed by author-removal commits, find each author's photos whose
+        URIs are gone from the file afterwards. The complete photo records
+        come from the files as they were before each commit, since unchanged
+        lines (like a shared commitdate) don't show up in the patches. Those
+        are read with a single git process. Returns removal entries.
+        """
+        def photo_uris(lines):
+            uris = set()
+            for line in lines:
+                [key, _, value] = line.partition(": ")
+                if key.find("photo.") == 0 and key.count(".") == 1:
+                    uris.add(value)
+            return uris
+        changes = []
+        for commit, author, path, removed, added in patches:
+            gone = photo_uris(removed) - photo_uris(added)
+            if len(gone) > 0:
+                changes.append([commit, author, path, gone])
+        blobs = read_git_blobs([commit + "~1:" + path for [commit, _, path, _] in changes])
+        entries = []
+        for [commit, author, path, gone] in changes:
+            contents = blobs[commit + "~1:" + path]
+            if contents == None:
                 continue
-            else:
-                for hunk in change:
-                    for line in hunk:
-                        if line.is_removed:
-                            # author must be at the end of a line, prepended with ": "
-                            line = line.value.strip()
-                            search_string = ": " + author
-                            if len(line) <= len(search_string):
-                                continue
-                            expected_location = len(line) - len(search_string)
-                            if line.find(search_string) == expected_location:
-                                counter = counter + 1
-        if counter > 0:
-            return commit
+            section = None
+            for section_name in ["wild", "media", "zoos", "pandas"]:
+                if section_name in path.split("/"):
+                    section = section_name.split("s")[0]   # HACK
+            photo_list = PhotoFile(section, path, contents=contents)
+            entry = {
+                "type": "removal",
+                "author": author,
+                "commit": commit,
+                "path": path,
+                "photos": OrderedDict()
+            }
+            for index, record in enumerate(photo_list.photos):
+                if record == None or record.get("") not in gone:
+                    continue
+                if record.get("author") != author:
+                    continue
+                photo_option = "photo." + str(index + 1)
+                for suffix, value in record.items():
+                    key = photo_option if suffix == "" else photo_option + "." + suffix
+                    entry["photos"][key] = value
+            if len(entry["photos"]) > 0:
+                entries.append(entry)
+        return entries
+
+    def record(self, commit, author):
+        """
+        Index an author removal that was just committed, from its patch. The
+        index has to be up to date with the commit's parent, so call update()
+        before making the commit.
+        """
+        commit = self.repo.commit(commit)
+        if self.indexed_commit != commit.parents[0].hexsha:
+            return self.update()
+        patches = [(sha, author, path, removed, added) for sha, path, removed, added
+                   in scan_data_file_patches([commit.hexsha, "-1"])]
+        self.__append(self.__removed_photos(patches), commit.hexsha)
+        return self
+
+    def update(self, progress=None):
+        """
+        Scan the commits made since the last indexed commit, and append any
+        photo removals they contain. If the last indexed commit is no longer
+        in the history (say, after a rebase), the index is rebuilt.
+        """
+        head = self.repo.head.commit.hexsha
+        if head == self.indexed_commit:
+            return self
+        arguments = [head]
+        if self.indexed_commit != None:
+            try:
+                self.repo.git.merge_base("--is-ancestor", self.indexed_commit, head)
+                arguments = [self.indexed_commit + ".." + head]
+            except git.exc.GitCommandError:
+                self.indexed_commit = None
+                self.removals = {}
+                self.restored = set()
+        # Only author-removal commits are worth looking at
+        arguments.append("--grep=^-author: ")
+        authors = {}
+        patches = []
+        for commit, path, removed, added in scan_data_file_patches(arguments, progress):
+            if commit not in authors:
+                authors[commit] = self.__removal_author(commit)
+            if authors[commit] != None:
+                patches.append((commit, authors[commit], path, removed, added))
+        if len(authors) > 0 and progress != None:
+            sys.stderr.write("\n")
+        # History comes newest-first, but the index is kept oldest-first
+        entries = self.__removed_photos(patches)
+        entries.reverse()
+        self.__append(entries, head)
+        return self
+
+    def lookup(self, author, commit=None):
+        """
+        Return the removal entries for an author from one commit: either the
+        given commit, or the most recent removal of their photos that hasn't
+        been restored yet.
+        """
+        removals = self.removals.get(author, [])
+        if commit == None:
+            removals = [entry for entry in removals
+                        if (author, entry["commit"]) not in self.restored]
+            if len(removals) == 0:
+                return []
+            commit = removals[-1]["commit"]
         else:
-            # Prepare for the next iteration
-            compare = commit
+            commit = self.repo.commit(commit).hexsha
+        return [entry for entry in removals if entry["commit"] == commit]
+
+    def mark_restored(self, author, commit):
+        """Note that an author's photos from a removal commit are back"""
+        if (author, commit) in self.restored:
+            return
+        self.restored.add((author, commit))
+        with open(self.index_path, "a", encoding="utf-8") as wfh:
+            wfh.write(json.dumps({"type": "restored", "author": author,
+                                  "commit": commit}) + "\n")
+
+def print_scan_progress(count, commit):
+    sys.stderr.write("\rscanned %s commits (%s)" % (count, commit[0:10]))
+    sys.stderr.flush()
 
-def remove_author_from_lineage(author):
+def read_git_blobs(revisions):
+    """
+    Read the contents of "<commit>:<path>" revisions with one `git cat-file
+    --batch` process, rather than a `git show` per file. Returns a dict of
+    revision to contents, or to None for revisions that don't exist.
+    """
+    if len(revisions) == 0:
+        return {}
+    request = "".join([revision + "\n" for revision in revisions]).encode("utf-8")
+    output = subprocess.run(["git", "cat-file", "--batch"], input=request,
+                            stdout=subprocess.PIPE, check=True).stdout
+    contents = {}
+    offset = 0
+    for revision in revisions:
+        end = output.index(b"\n", offset)
+        header = output[offset:end].decode("utf-8")
+        offset = end + 1
+        if header.endswith(" missing") or header.endswith(" ambiguous"):
+            contents[revision] = None
+            continue
+        size = int(header.split(" ")[-1])
+        contents[revision] = output[offset:offset + size].decode("utf-8")
+        offset = offset + size + 1   # Each object is followed by a newline
+    return contents
+
+def remove_author_from_lineage(author, jobs=1):
     """
     Occasionally users will remove or rename their photo files online.
     For cases where the original files cannot be recovered, it may be
     simpler to remove photos by an author and add them back later.
 
     Given a author (typically an IG username), remove their photos
-    from every panda or zoo data entry.
+    from every panda or zoo data entry. Files are processed by a pool of
+    jobs worker processes, and everything they changed is staged at once.
     """
     repo = git.Repo(".")
-    for file_path in [PANDA_PATH, ZOO_PATH, MEDIA_PATH]:
-        section = None
-        for section_name in ["media", "zoos", "pandas"]:
-            if section_name in file_path.split("/"):
-                section = section_name.split("s")[0]   # HACK
-        # Enter the pandas subdirectories
-        for root, dirs, files in os.walk(file_path):
-            for filename in files:
-                path = root + os.sep + filename
-                photo_list = PhotoFile(section, path)
-                photo_list.remove_author(author)
-                # Done? Let's write config
-                photo_list.update_file()
-                repo.git.add(path)
+    removal_index = AuthorRemovalIndex(repo).update(print_scan_progress)
+    index = load_dataset_index()
+    # Only visit the files the dataset index says credit this author
+    work = [[record["section"], record["path"], author] for record
+            in index.entries_with_author(author, ["media", "panda", "zoo"])]
+    stager = GitStager(repo)
+    stager.add_all(run_per_file(remove_author_from_file, work, jobs))
+    stager.stage()
     message = "-author: {author}".format(author=author)
-    repo.index.commit(message)
+    commit = repo.index.commit(message)
+    # Record what was removed, so it can be restored without a history search
+    removal_index.record(commit, author)
     repo.close()
 
+def remove_author_from_file(section, path, author):
+    """
+    Remove one author's photos from a single data file. Returns the path if
+    the file was rewritten, or None otherwise.
+    """
+    photo_list = PhotoFile(section, path)
+    photo_list.remove_author(author)
+    # Done? Let's write config, if anything was removed
+    if photo_list.update_file() == False:
+        return None
+    return path
+
 def remove_photo_from_file(path, photo_id):
     """
     Given a file path and a photo index ID, remove the photo and renumber
@@ -93,9 +289,7 @@ def remove_photo_from_file(path, photo_id):
     photo_list = PhotoFile(section, path)
     photo_url = photo_list.get_photo(photo_id)
     if photo_list.delete_photo(photo_id) == True:
-        # Read max from an existing photo
-        max = int(get_max_entity_count())
-        photo_list.renumber_photos(max)
+        photo_list.renumber_photos()
         photo_list.update_file()
         repo.git.add(path)
     message = "-photo: {id}".format(id=photo_id)
@@ -121,152 +315,190 @@ def remove_photo_from_server(locator):
     print('Removing {image} from the server'.format(image=filename))
     os.system(rm_command)
 
-def remove_duplicate_photo_uris_per_file():
+def report_duplicate_photo_uris():
+    """
+    List every photo that appears more than once in the dataset, by its
+    normalized URI. Repeats inside one data file are listed first, then
+    photos shared between different pandas, zoos, media or wild files.
+    """
+    index = load_dataset_index()
+    within = []
+    across = []
+    for key, places in index.duplicate_photo_uris().items():
+        paths = list(OrderedDict.fromkeys([path for [path, _] in places]))
+        for path in paths:
+            indexes = [photo_index for [place, photo_index] in places if place == path]
+            if len(indexes) > 1:
+                within.append("%s: %s -- %s" % (
+                    path, ", ".join(["photo." + str(i) for i in indexes]), key))
+        if len(paths) > 1:
+            across.append("%s: %s" % (key, ", ".join(
+                ["%s photo.%s" % (path, photo_index) for [path, photo_index] in places])))
+    print("duplicated within a file: %s" % len(within))
+    for line in within:
+        print("  " + line)
+    print("duplicated across entities: %s" % len(across))
+    for line in across:
+        print("  " + line)
+
+def remove_duplicate_photo_uris_across_files():
+    """
+    If the same photo is listed in more than one file for the same entity
+    (same section and _id, like a data file that got duplicated or moved
+    without removing the old copy), keep only the copy with the earliest
+    commitdate, and fold the tags of the other copies into it.
+
+    Photos shared between different entities are legitimate: two pandas in
+    one photo, or a panda and its zoo. Those are left alone, and only show
+    up in report_duplicate_photo_uris.
+    """
+    repo = git.Repo(".")
+    index = load_dataset_index()
+    photo_files = OrderedDict()
+    def photo_file(path):
+        if path not in photo_files:
+            photo_files[path] = PhotoFile(index.records[path]["section"], path)
+        return photo_files[path]
+    for key, places in index.duplicate_photo_uris().items():
+        by_entity = OrderedDict()
+        for place in places:
+            record = index.records[place[0]]
+            if record["id"] == None:
+                continue
+            by_entity.setdefault((record["section"], record["id"]), []).append(place)
+        for entity, section_places in by_entity.items():
+            if len(set([path for [path, _] in section_places])) < 2:
+                continue
+            # Earliest commitdate wins, and ties go to the first file by path
+            commitdates = datetimes_to_unixtimes(
+                [photo_file(path).get_field("photo." + str(photo_index) + ".commitdate")
+                 for [path, photo_index] in section_places])
+            earliest = commitdates.index(min(commitdates))
+            [keep_path, keep_index] = section_places[earliest]
+            for [path, photo_index] in section_places:
+                if [path, photo_index] == [keep_path, keep_index]:
+                    continue
+                duplicate = photo_file(path).photos[photo_index - 1]
+                photo_file(keep_path).merge_photo(keep_index, duplicate)
+                photo_file(path).delete_photo(photo_index)
+    updated_paths = []
+    for path, photo_list in photo_files.items():
+        if photo_list.dirty == False:
+            continue
+        print("deduplicated: %s" % path)
+        photo_list.renumber_photos()
+        photo_list.update_file()
+        sort_image_locators(path)
+        updated_paths.append(path)
+    stager = GitStager(repo)
+    stager.add_all(updated_paths)
+    stager.stage()
+    message = repo.commit("HEAD").message
+    repo.index.commit("deduped across files: " + message)
+    repo.close()
+
+def remove_duplicate_photo_uris_per_file(jobs=1):
     """
     If a file has the same photo URI multiple times, make a new photo entry
     with a union of the tags for each one, and the earlier commitdate.
-    TODO: support media duplicates
+    Files are processed by a pool of jobs worker processes, and everything
+    they changed is staged at once.
     """
     repo = git.Repo(".")
-    max = int(get_max_entity_count())
-    for file_path in [PANDA_PATH, ZOO_PATH]:
-        section = None
-        for section_name in ["zoos", "pandas"]:
-            if section_name in file_path.split("/"):
-                section = section_name.split("s")[0]   # HACK
-        # Enter the pandas subdirectories
-        for root, dirs, files in os.walk(file_path):
-            for filename in files:
-                path = root + os.sep + filename
-                # print(path)
-                photo_list = PhotoFile(section, path)
-                photo_count = photo_list.photo_count()
-                photo_index = 1
-                seen = {}
-                duplicates = {}
-                while (photo_index <= photo_count):
-                    current_option = "photo." + str(photo_index)
-                    current_uri = photo_list.get_field(current_option)
-                    current_author_option = current_option + ".author"
-                    current_author = photo_list.get_field(current_author_option)
-                    current_date_option = current_option + ".commitdate"
-                    current_date = photo_list.get_field(current_date_option)
-                    current_date_value = datetime_to_unixtime(current_date)
-                    current_link_option = current_option + ".link"
-                    current_link = photo_list.get_field(current_link_option)
-                    current_tags_option = current_option + ".tags"
-                    current_tags = photo_list.get_field(current_tags_option)
-                    if current_uri in seen:
-                        # We have a duplicate
-                        seen_date_value = datetime_to_unixtime(seen[current_uri]["commitdate"])
-                        seen_tags = seen[current_uri]["tags"]
-                        # Resolve dates and tags
-                        if (current_date_value < seen_date_value):
-                            seen[current_uri]["commitdate"] = current_date_value
-                        # Handle when either of the duplicates have no tags
-                        if seen_tags == None and current_tags != None:
-                            seen[current_uri]["tags"] = current_tags
-                        if seen_tags != None and current_tags != None: 
-                            tag_list = current_tags.split(", ") + seen_tags.split(", ")
-                            tag_list = sorted(list(dict.fromkeys(tag_list)))   # deduplicate tags
-                            seen[current_uri]["tags"] = ", ".join(tag_list)
-                        # Add to duplicates list in its current form
-                        duplicates[current_uri] = seen[current_uri]
-                        # Remove from the photo list
-                        photo_list.delete_photo(photo_index)
-                        photo_list.delete_photo(seen[current_uri]["old_index"])
-                    elif current_uri in duplicates:
-                        # We have something duplicated more than once
-                        seen_date_value = datetime_to_unixtime(duplicates[current_uri]["commitdate"])
-                        seen_tags = duplicates[current_uri]["tags"]
-                        # Resolve dates and tags
-                        if (current_date_value < seen_date_value):
-                            duplicates[current_uri]["commitdate"] = current_date_value
-                        # Handle when either of the duplicates have no tags
-                        if seen_tags == None and current_tags != None:
-                            seen[current_uri]["tags"] = current_tags
-                        if seen_tags != None and current_tags != None:
-                            tag_list = current_tags.split(", ") + seen_tags.split(", ")
-                            tag_list = sorted(list(dict.fromkeys(tag_list)))   # deduplicate tags
-                            duplicates[current_uri]["tags"] = ", ".join(tag_list)
-                        # Remove from the photo list
-                        photo_list.delete_photo(photo_index)
-                    else:
-                        seen[current_uri] = {}
-                        seen[current_uri]["old_index"] = photo_index
-                        seen[current_uri]["author"] = current_author
-                        seen[current_uri]["commitdate"] = current_date
-                        seen[current_uri]["link"] = current_link
-                        seen[current_uri]["tags"] = current_tags
-                    photo_index = photo_index + 1
-                for photo_uri in duplicates.keys():
-                    # Add duplicates back to photo file, starting at the newest index
-                    photo_option = "photo." + str(photo_index)
-                    author_option = photo_option + ".author"
-                    author = duplicates[photo_uri]["author"]
-                    date_option = photo_option + ".commitdate"
-                    date = duplicates[photo_uri]["commitdate"]
-                    link_option = photo_option + ".link"
-                    link = duplicates[photo_uri]["link"]
-                    tags_option = photo_option + ".tags"
-                    tags = duplicates[photo_uri]["tags"]
-                    photo_list.set_field(photo_option, photo_uri)
-                    photo_list.set_field(author_option, author)
-                    photo_list.set_field(date_option, date)
-                    photo_list.set_field(link_option, link)
-                    if (tags != None):
-                        photo_list.set_field(tags_option, tags)
-                    photo_index = photo_index + 1
-                # Update the file if there were any changes, and re-sort the hashes
-                duplicate_count = len(duplicates.keys())
-                if duplicate_count > 0:
-                    print("deduplicated: %s (%s duplicated)" % (path, duplicate_count))
-                    photo_list.renumber_photos(max)
-                    photo_list.update_file()
-                    sort_image_locators(path)
-                    repo.git.add(path)
+    index = load_dataset_index()
+    # Only visit the files the dataset index says have repeated photo URIs
+    work = [[record["section"], record["path"]] for record
+            in index.entries_with_duplicate_photos()]
+    stager = GitStager(repo)
+    stager.add_all(run_per_file(remove_duplicate_photo_uris_in_file, work, jobs))
+    stager.stage()
     message = repo.commit("HEAD").message
     repo.index.commit("deduped: " + message)
     repo.close()
 
+def remove_duplicate_photo_uris_in_file(section, path):
+    """
+    Merge repeated photo URIs in a single data file into the first photo that
+    uses them. URIs are compared by normalize_photo_uri, so the same IG post
+    at different sizes counts as a duplicate. Returns the path if the file
+    was rewritten, or None otherwise.
+    """
+    photo_list = PhotoFile(section, path)
+    first_index = {}
+    duplicate_count = 0
+    for photo_index, record in enumerate(photo_list.photos, start=1):
+        if record == None or "" not in record:
+            continue
+        key = normalize_photo_uri(record[""])
+        if key not in first_index:
+            first_index[key] = photo_index
+            continue
+        photo_list.merge_photo(first_index[key], record)
+        photo_list.delete_photo(photo_index)
+        duplicate_count = duplicate_count + 1
+    # Update the file if there were any changes, and re-sort the hashes
+    if duplicate_count > 0:
+        print("deduplicated: %s (%s duplicated)" % (path, duplicate_count))
+        photo_list.renumber_photos()
+        photo_list.update_file()
+        sort_image_locators(path)
+        return path
+    return None
+
 def restore_author_to_lineage(author, prior_commit=None):
     """
-    Find the most recent commit where photos by an author were removed.
-    Re-add them to the pandas they were removed from. For any panda that
-    had photos restored, sort their photo hashes.
+    Find the most recent commit where photos by an author were removed, or
+    use the given commit. Re-add them to the pandas they were removed from. For
+    any panda that had photos restored, sort their photo hashes.
+
+    The removed photos come from the author removal index. If the index has
+    nothing for this author, fall back to searching the git history.
     """
     repo = git.Repo(".")
+    removal_index = AuthorRemovalIndex(repo).update(print_scan_progress)
+    removals = removal_index.lookup(author, prior_commit)
+    if len(removals) > 0:
+        path_to_photo_index = {}
+        for entry in removals:
+            path_to_photo_index.setdefault(entry["path"], {}).update(entry["photos"])
+        restore_photos_to_lineage(repo, author, path_to_photo_index)
+        removal_index.mark_restored(author, removals[0]["commit"])
+        return
+    if prior_commit == None and len(removal_index.removals.get(author, [])) > 0:
+        print("Every removal of photos by %s has already been restored" % author)
+        return
     if prior_commit == None:
-        prior_commit = find_commit_of_removed_photos(author, repo)
-    # Go back one more from this commit
-    current_commit = prior_commit
-    prior_commit = str(prior_commit) + "~1"    
-    diff_raw = repo.git.diff(prior_commit, 
-                             current_commit,
-                             ignore_blank_lines=True,
-                             ignore_space_at_eol=True)
+        scanner = scan_removed_author_photos(author, progress=print_scan_progress)
+    else:
+        scanner = scan_removed_author_photos(author, rev=str(prior_commit), max_count=1)
     # Make list of removed lines per filename, and convert.
     # Handjam this just by iterating on file lines
     path_to_photo_index = {}
-    patch = PatchSet(diff_raw)
-    for change in patch:
-        filename = change.path
-        if filename.find(".txt") == -1:
-            # Don't care about non-data files
-            continue
-        elif change.removed <= 0:
-            # No lines were removed, so we don't care
-            continue
-        else:
-            # Prepare to add lines
+    target_commit = None
+    if prior_commit != None:
+        target_commit = str(repo.commit(prior_commit))
+    try:
+        for commit, filename, removed in scanner:
+            # Only take the files from the most recent matching commit
+            if target_commit == None:
+                target_commit = commit
+            if commit != target_commit:
+                break
             path_to_photo_index[filename] = {}
-            for hunk in change:
-                for line in hunk:
-                    if line.is_removed:
-                        if line.value.find("photo.") != 0:
-                            continue
-                        [key, value] = line.value.strip().split(": ")
-                        path_to_photo_index[filename][key] = value
+            for line in removed:
+                if line.find("photo.") != 0:
+                    continue
+                [key, _, value] = line.partition(": ")
+                path_to_photo_index[filename][key] = value
+    finally:
+        scanner.close()
+    restore_photos_to_lineage(repo, author, path_to_photo_index)
+
+def restore_photos_to_lineage(repo, author, path_to_photo_index):
+    """
+    Given a map of data file paths to the photo.N.* fields removed from them,
+    add those photos back to the ends of the files and commit the result.
+    """
     # Delete any items where the author isn't the given
     for path in path_to_photo_index.keys():
         for option in list(path_to_photo_index[path].keys()):
@@ -280,7 +512,7 @@ def restore_author_to_lineage(author, prior_commit=None):
             # File may have been moved.
             print("%s:\nfile no longer exists, so where do I put this?" % path)
             for key in path_to_photo_index[path].keys():
-                print("%s: %s" % (key, value))
+                print("%s: %s" % (key, path_to_photo_index[path][key]))
             continue
         section = None
         for section_name in ["wild", "media", "zoos", "pandas"]:
@@ -303,13 +535,119 @@ def restore_author_to_lineage(author, prior_commit=None):
         # Update the list of photos
         photo_list.update_file()
     # Finally, sort the photo files
+    stager = GitStager(repo)
     for path in path_to_photo_index.keys():
+        if not os.path.exists(path):
+            continue
         sort_image_locators(path)
-        repo.git.add(path)
+        stager.add(path)
+    stager.stage()
     message = "+author: {author}".format(author=author)
     repo.index.commit(message)
     repo.close()
 
+def run_per_file(worker, work, jobs=1):
+    """
+    Call worker(*args) for every argument list in work, either serially or
+    fanned out over a pool of jobs processes. Workers return the path they
+    changed, or None. Returns the list of changed paths.
+    """
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(worker, *args) for args in work]
+            results = [future.result() for future in futures]
+    else:
+        results = [worker(*args) for args in work]
+    return [path for path in results if path != None]
+
+def scan_data_file_patches(arguments, progress=None):
+    """
+    Stream `git log -p` output for the data files, newest commit first, and
+    yield a tuple of (commit, path, removed_lines, added_lines) for each file
+    changed in each commit. Extra git log arguments (revisions, pickaxe
+    searches, limits) go in the arguments list.
+
+    The patch text is parsed line by line from the pipe rather than being
+    materialized, and the git process is stopped as soon as the caller stops
+    iterating. If given, progress(count, commit) is called for every commit
+    the scan reaches.
+    """
+    command = ["git", "-c", "core.quotepath=false", "log", "-p", "--no-color",
+               "--no-ext-diff", "--format=commit %H"]
+    command.extend(arguments)
+    command.extend(["--", "*.txt"])
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL, encoding="utf-8")
+    commit = None
+    path = None
+    removed = []
+    added = []
+    count = 0
+    in_hunk = False
+    try:
+        for line in process.stdout:
+            line = line.rstrip("\n")
+            # Patch lines always start with " ", "+", "-" or "\\", so these
+            # headers can't be confused with the contents of a data file
+            if line.find("commit ") == 0 or line.find("diff --git ") == 0:
+                # Finished a file (and maybe a commit), so report on it
+                if path != None:
+                    yield (commit, path, removed, added)
+                path = None
+                removed = []
+                added = []
+                in_hunk = False
+                if line.find("commit ") == 0:
+                    commit = line.split(" ")[1]
+                    count = count + 1
+                    if progress != None:
+                        progress(count, commit)
+            elif line.find("--- ") == 0 and not in_hunk:
+                path = line[4:]
+                if path.find("a/") == 0:
+                    path = path[2:]
+            elif line.find("@@") == 0:
+                in_hunk = True
+            elif in_hunk and line.find("-") == 0:
+                removed.append(line[1:].strip())
+            elif in_hunk and line.find("+") == 0:
+                added.append(line[1:].strip())
+        if path != None:
+            yield (commit, path, removed, added)
+    finally:
+        process.kill()
+        process.stdout.close()
+        process.wait()
+
+def scan_removed_author_photos(author, rev="master", max_count=None, progress=None):
+    """
+    Stream the history of the data files, newest first, and yield a tuple of
+    (commit, path, removed_lines) for every file in a commit that removed a
+    line crediting the author (a line that ends in ": <author>"). All of the
+    lines removed from that file in that commit are included, so callers can
+    rebuild the removed photos.
+
+    The git log runs with a pickaxe search (-S) so that git itself skips
+    commits that don't change how often the author appears.
+    """
+    search_string = ": " + author
+    arguments = ["-S", search_string]
+    if max_count != None:
+        arguments.append("--max-count=" + str(max_count))
+    arguments.append(rev)
+    def credits_author(lines):
+        for line in lines:
+            if line.endswith(search_string) and len(line) > len(search_string):
+                return True
+        return False
+    patches = scan_data_file_patches(arguments, progress)
+    try:
+        for commit, path, removed, added in patches:
+            if credits_author(removed):
+                yield (commit, path, removed)
+    finally:
+        patches.close()
+
 def sort_image_locators(path):
     """
     Take a zoo/panda file, and sort all photos by their cwdc:// locators. This
@@ -318,8 +656,6 @@ def sort_image_locators(path):
     cwdc:// locators is that every image link in the file must use one of these
     locators. If we find any photos that don't then we skip this file.
     """
-    # RPF image locators use the same IG base64 alphabet for hashes, time 
-    # ordering oldest to newest
     # print(path)
     print("cwdc image sorting: %s" % path)
     section = None
@@ -327,77 +663,19 @@ def sort_image_locators(path):
         if section_name in path.split("/"):
             section = section_name.split("s")[0]   # HACK
     photo_list = PhotoFile(section, path)
-    photo_count = photo_list.photo_count()
-    max = int(get_max_entity_count()) + 1
-    if photo_count >= max:
-        max = photo_count + 1
-    cwdc_photos = []
-    # Build photo indices of IG locator links and non-IG photos
-    start_index = 1
-    stop_point = max
-    photo_index = start_index
-    while photo_index <= stop_point:
-        photo_option = "photo." + str(photo_index)
-        photo = photo_list.get_field(photo_option)
-        if photo == None:
-            # Missing photo at this index, continue
-            photo_index = photo_index + 1
+    for record in photo_list.photos:
+        if record == None or "" not in record:
             continue
-        # If our updated photo link has an ig:// uri, do the moving
-        if "cwdc://" in photo:
-            # Track the photo and index as a tuple
-            cwdc_photos.append([photo, photo_index])
-            # Rename all photo fields as "old_photo_field"
-            photo_list.move_field("old." + photo_option, photo_option)
-            photo_list.move_field("old." + photo_option + ".author", photo_option + ".author")
-            photo_list.move_field("old." + photo_option + ".commitdate", photo_option + ".commitdate")
-            photo_list.move_field("old." + photo_option + ".link", photo_option + ".link")
-            photo_list.move_field("old." + photo_option + ".tags", photo_option + ".tags")
-            if section == "media":
-                panda_tags = photo_list.get_field("panda.tags").split(", ")
-                for panda_id in panda_tags:
-                    photo_item = photo_option + ".tags." + panda_id + ".location"
-                    photo_list.move_field("old." + photo_item, photo_item)
-        else:
+        if "cwdc://" not in record[""]:
             # Only update files that have cwdc:// links for every photo
             return False
-        photo_index = photo_index + 1
-    # Sort the list of cwdc photo tuples by photo URL
-    # Must chop off the extension b/c no . in the HASH_ORDER base64 alphabet
-    cwdc_photos = sorted(
-        cwdc_photos, 
-        key=lambda x: 
-            [HASH_ORDER.index(char) for char in x[0].split("/")[-1].split(".")[0]])
-    cwdc_photos = sorted(cwdc_photos, key=lambda x: len(x[0].split("/")[-1].split(".")[0]))
-    # Now, re-distribute the photos, iterating down the cwdc
-    # photos, moving "old_photo_field" to "photo_field" but with
-    # updated indices
-    list_index = start_index
-    photo_index = start_index
-    used_indices = []
-    while photo_index <= stop_point:
-        if list_index - 1 == len(cwdc_photos):
-            # No more photos, for certain
-            break
-        [photo, old_index] = cwdc_photos[list_index - 1]
-        photo_index = list_index
-        while photo_index in used_indices:
-            photo_index = photo_index + 1   # Avoid indices we already used
-        used_indices.append(photo_index)
-        current_option = "photo." + str(photo_index)
-        old_option = "old.photo." + str(old_index)
-        photo_list.move_field(current_option, old_option)
-        photo_list.move_field(current_option + ".author", old_option + ".author")
-        photo_list.move_field(current_option + ".commitdate", old_option + ".commitdate")
-        photo_list.move_field(current_option + ".link", old_option + ".link")
-        photo_list.move_field(current_option + ".tags", old_option + ".tags")
-        if section == "media":
-            panda_tags = photo_list.get_field("panda.tags").split(", ")
-            for panda_id in panda_tags:
-                current_loc_tag =  current_option + ".tags." + panda_id + ".location"
-                old_loc_tag = old_option + ".tags." + panda_id + ".location"
-                photo_list.move_field(current_loc_tag, old_loc_tag)
-        list_index = list_index + 1
+    # Photo records move as a unit, location tags and all. Any stray photo
+    # fields without a photo URI go after the sorted photos.
+    def locator_order(record):
+        if "" not in record:
+            return (1, 0, 0)
+        return (0,) + hash_locator_key(record[""])
+    photo_list.sort_photos(key=locator_order)
     # We're done. Update the photo file
     photo_list.update_file()
     return True
@@ -432,26 +710,50 @@ def sort_image_updates():
             if sort_image_locators(filename) == True:
                 updated_paths.append(filename)
     # Add updated files after we're done with all patch analysis
-    for filename in set(updated_paths):
-        repo.git.add(filename)
+    stager = GitStager(repo)
+    stager.add_all(updated_paths)
+    stager.stage()
     message = repo.commit("HEAD").message
     repo.index.commit("image-locator sorted commit:\n" + message)
     repo.close()
 
 if __name__ == '__main__':
     """Choose a utility function."""
+    jobs = 1
+    if "--jobs" in sys.argv:
+        position = sys.argv.index("--jobs")
+        jobs = int(sys.argv[position + 1])
+        if jobs < 1:
+            print("Jobs count must be positive.")
+            sys.exit()
+        del sys.argv[position:position + 2]
     if len(sys.argv) == 2:
+        if sys.argv[1] == "--index-author-removals":
+            repo = git.Repo(".")
+            AuthorRemovalIndex(repo).update(print_scan_progress)
+            repo.close()
         if sys.argv[1] == "--deduplicate-photo-uris":
-            remove_duplicate_photo_uris_per_file()
+            remove_duplicate_photo_uris_per_file(jobs)
+        if sys.argv[1] == "--deduplicate-photo-uris-across-files":
+            remove_duplicate_photo_uris_across_files()
+        if sys.argv[1] == "--report-duplicate-photo-uris":
+            report_duplicate_photo_uris()
         if sys.argv[1] == "--sort-image-updates":
             sort_image_updates()
     if len(sys.argv) == 3:
         if sys.argv[1] == "--remove-author":
             author = sys.argv[2]
-            remove_author_from_lineage(author)
+            remove_author_from_lineage(author, jobs)
         if sys.argv[1] == "--restore-author":
             author = sys.argv[2]
             restore_author_to_lineage(author)
+        if sys.argv[1] == "--list-author-removals":
+            author = sys.argv[2]
+            repo = git.Repo(".")
+            index = AuthorRemovalIndex(repo).update(print_scan_progress)
+            for entry in index.removals.get(author, []):
+                print("%s %s (%s fields)" % (entry["commit"], entry["path"], len(entry["photos"])))
+            repo.close()
         if sys.argv[1] == "--sort-image-locators":
             file_path = sys.argv[2]
             if sort_image_locators(file_path) == False:
@@ -2,115 +2,252 @@
 
 # Tools for making subsets / samples of Red Panda Lineage data
 
+import bisect
 import os
 import random
 import sys
 
+from fetch import PhotoFetcher
 from shared import *
 
-def collect_photo_uris(min_photos=0, species=["1", "2"], taglist=None):
+class PhotoQueryIndex():
     """
-    Collect all photo uris in the dataset that match:
+    Inverted indexes over the panda photos in the dataset index, for finding
+    photos by tag, species, and how many photos their animal has, without
+    opening any data files.
+
+    Every photo gets a number, and an animal's photos are numbered in a
+    row. Each tag maps to a bitmap of its photo numbers, held in a Python
+    int, so a query for several tags is a few bitwise ANDs. Species map to
+    lists of animals, and animals are also kept sorted by photo count, so a
+    minimum photo count is a binary search.
+    """
+    def __init__(self, dataset_index):
+        self.records = dataset_index.entries(["panda"])
+        self.first_photo = []     # Animal -> number of its photo.1
+        self.species = {}         # Species -> animals
+        self.by_count = []        # [photo count, animal], sorted
+        tag_photos = {}
+        photo_id = 0
+        for animal, record in enumerate(self.records):
+            self.first_photo.append(photo_id)
+            self.species.setdefault(record["species"], []).append(animal)
+            self.by_count.append([record["photo_count"], animal])
+            for tags in record["tags"]:
+                for tag in tags:
+                    tag_photos.setdefault(tag, []).append(photo_id)
+                photo_id = photo_id + 1
+        self.photo_total = photo_id
+        self.by_count.sort()
+        self.counts = [count for [count, _] in self.by_count]
+        self.tags = {tag: self.__bitmap(ids) for tag, ids in tag_photos.items()}
+
+    def __bitmap(self, photo_ids):
+        bits = bytearray(self.photo_total // 8 + 1)
+        for photo_id in photo_ids:
+            bits[photo_id >> 3] |= 1 << (photo_id & 7)
+        return int.from_bytes(bits, "little")
+
+    def __animals_bitmap(self, animals):
+        bitmap = 0
+        for animal in animals:
+            count = self.records[animal]["photo_count"]
+            bitmap |= ((1 << count) - 1) << self.first_photo[animal]
+        return bitmap
+
+    def query(self, taglist=None, species=None, min_photos=0):
+        """
+        Find photos that have every tag in taglist, whose animals are one of
+        the species and have at least min_photos photos. Returns a list of
+        [record, photo indexes] for each animal with matching photos.
+        """
+        animals = None
+        if species != None:
+            animals = set()
+            for specie in species:
+                animals.update(self.species.get(specie, []))
+        if min_photos > 0:
+            start = bisect.bisect_left(self.counts, min_photos)
+            enough = set([animal for [_, animal] in self.by_count[start:]])
+            animals = enough if animals == None else animals & enough
+        bitmap = (1 << self.photo_total) - 1
+        if animals != None:
+            bitmap = self.__animals_bitmap(animals)
+        for tag in taglist or []:
+            bitmap &= self.tags.get(tag, 0)
+        # Walk the set bits, lowest photo number first
+        matches = []
+        bits = bin(bitmap)[:1:-1]
+        photo_id = bits.find("1")
+        while photo_id != -1:
+            animal = bisect.bisect_right(self.first_photo, photo_id) - 1
+            photo_index = photo_id - self.first_photo[animal] + 1
+            if len(matches) == 0 or matches[-1][0] is not self.records[animal]:
+                matches.append([self.records[animal], []])
+            matches[-1][1].append(photo_index)
+            photo_id = bits.find("1", photo_id + 1)
+        return matches
+
+def collect_photo_uris(min_photos=0, species=["1", "2"], taglist=None, max_age=None):
+    """
+    Yield every photo in the dataset that matches:
     - A minimum number of photos for the animal
     - An array of possible species (defaults to ["1", "2"] which gets all)
     - A list of photo tags (defaults to getting photos regardless of tag)
+    - A maximum photo age in seconds, by commitdate (such as COMMIT_AGE)
+    Photos come out grouped by animal, one data file at a time. Only the
+    files with matching photos get opened, and each is parsed once and let
+    go once its photos are out, so only the chosen photos stay in memory.
     """
-    matched_photos = []
-    for file_path in [PANDA_PATH]:
-        section = None
-        for section_name in ["pandas"]:
-            if section_name in file_path.split("/"):
-                section = section_name.split("s")[0]   # HACK
-        # Enter the pandas subdirectories
-        for root, dirs, files in os.walk(file_path):
-            for filename in files:
-                path = root + os.sep + filename
-                # print(path)
-                photo_list = PhotoFile(section, path)
-                photo_count = photo_list.photo_count()
-                if photo_count == 0:
-                    # Ignore if panda has no photos
+    today = current_date_to_unixtime()
+    query = PhotoQueryIndex(load_dataset_index())
+    for [record, photo_indexes] in query.query(taglist, species, min_photos):
+        photo_list = PhotoFile(record["section"], record["path"])
+        for photo_index in photo_indexes:
+            key = "photo." + str(photo_index)
+            photo = PhotoEntry(photo_list.file_path, key + ": " + photo_list.get_field(key), photo_list)
+            # If we have an age limit, only collect recently added photos
+            if max_age != None:
+                if photo.commitdate == None:
                     continue
-                if photo_count < min_photos:
-                    # Ignore if this panda doesn't have enough photos
+                if within_commit_age(photo.commitdate, max_age, today) == False:
                     continue
-                # Ignore if it's not the species we want
-                if (photo_list.get_field("species") not in species):
-                    continue
-                photo_index = 1
-                while (photo_index <= photo_count):
-                    current_photo = "photo." + str(photo_index)
-                    current_tag = "photo." + str(photo_index) + ".tags"
-                    # If we have a taglist, only collect photos in the list
-                    if taglist != None:
-                        if photo_list.array_has_all_values(current_tag, taglist) == False:
-                            photo_index = photo_index + 1
-                            continue
-                    # Collect photos
-                    value = photo_list.get_field(current_photo)
-                    raw = current_photo + ": " + value
-                    photo = PhotoEntry(path, raw)
-                    matched_photos.append(photo)
-                    photo_index = photo_index + 1
-    return matched_photos
-
-def define_min_photo_sample(min_count=40, photo_count=40, species=["1", "2"]):
+            # Collect photos
+            yield photo
+
+def print_photo_query(min_photos=0, species=["1", "2"], taglist=None, max_age=None):
     """
-    Fetch a sample of all animals that have at least N photos in the dataset.
-    Defaults to 40 photos.
-    """
-    output_photos = []
-    matched_photos = collect_photo_uris(min_count, species)
-    # Shuffle the list of photos that match our interest
-    random.shuffle(matched_photos)
-    # Take entire photo set we've gathered, and whittle it down to
-    # the animal_count and photo_count set of photos.
-    animal_id_dict = {}
-    #!!!! TODO why doesn't photo-count matter?
-    for photo in matched_photos:
-        # Count how many photos of each animal we've gone through
-        if photo.entity_id not in animal_id_dict:
-            animal_id_dict[photo.entity_id] = 1
-        else:
-            animal_id_dict[photo.entity_id] = animal_id_dict[photo.entity_id] + 1
-        if animal_id_dict[photo.entity_id] > photo_count:
-            # We have enough photos of this animal
-            continue
+    Print the photos a sample would choose from, without fetching anything.
+    Commitdates aren't in the dataset index, so an age limit means opening
+    the data files.
+    """
+    if max_age != None:
+        photo_count = 0
+        animals = set()
+        for photo in collect_photo_uris(min_photos, species, taglist, max_age):
+            print("%s photo.%s: %s" % (photo.filename, photo.photo_index, photo.photo_uri))
+            animals.add(photo.entity_id)
+            photo_count = photo_count + 1
+        print("%s photos of %s animals" % (photo_count, len(animals)))
+        return
+    query = PhotoQueryIndex(load_dataset_index())
+    matches = query.query(taglist, species, min_photos)
+    photo_count = 0
+    for [record, photo_indexes] in matches:
+        for photo_index in photo_indexes:
+            print("%s photo.%s: %s" % (record["path"], photo_index,
+                                       record["photos"][photo_index - 1]))
+        photo_count = photo_count + len(photo_indexes)
+    print("%s photos of %s animals" % (photo_count, len(matches)))
+
+# Ways to group photos for stratified samples
+STRATA = {
+    "animal": lambda photo: photo.entity_id,
+    "species": lambda photo: photo.species,
+    "zoo": lambda photo: photo.filename.split("/")[-2]
+}
+
+class StratifiedSampler():
+    """
+    Streaming random sampler. Photos are split into strata (by animal, by
+    default), and each stratum keeps a reservoir of up to per_stratum photos,
+    so every photo of a stratum has the same chance of being picked. If
+    max_strata is set, the strata themselves are reservoir-sampled as they
+    first appear, so each stratum has the same chance of being picked too.
+
+    Every photo is looked at once, and only the photos that might end up in
+    the sample are kept in memory. Pass a seeded random.Random as rng to get
+    the same sample back for the same dataset.
+    """
+    def __init__(self, per_stratum, max_strata=None, stratum=STRATA["animal"], rng=None):
+        self.per_stratum = per_stratum
+        self.max_strata = max_strata
+        self.stratum = stratum
+        self.rng = rng if rng != None else random.Random()
+        self.strata = []         # Kept strata, in sample output order
+        self.reservoirs = {}     # Stratum -> [photos seen, kept photos]
+        self.skipped = set()     # Strata that lost out to other strata
+        self.strata_seen = 0
+
+    def __admit(self, key):
+        """
+        Decide whether a newly-seen stratum gets a reservoir, evicting a
+        random kept stratum if we're at max_strata.
+        """
+        self.strata_seen = self.strata_seen + 1
+        if self.max_strata == None or len(self.strata) < self.max_strata:
+            self.strata.append(key)
         else:
-            output_photos.append(photo)
-    return output_photos
-
-def define_random_tag_sample(num_animals, num_photos, species, taglist):
-    """
-    Fetch a random sample of the Red Panda Lineage project's linked photos.
-    """
-    output_photos = []
-    matched_photos = collect_photo_uris(0, species, taglist)
-    # Shuffle the list of photos that match our interest
-    random.shuffle(matched_photos)
-    # Take entire photo set we've gathered, and whittle it down to
-    # the animal_count and photo_count set of photos.
-    animal_id_list = []
-    for photo in matched_photos:
-        # Don't go over the photo count overall
-        if len(output_photos) == num_photos:
-            break
-        if photo.entity_id not in animal_id_list:
-            # Don't go over your animal count
-            if len(animal_id_list) < num_animals:
-                output_photos.append(photo)
-                animal_id_list.append(photo.entity_id)
-            else:
-                continue
+            slot = self.rng.randrange(self.strata_seen)
+            if slot >= self.max_strata:
+                self.skipped.add(key)
+                return False
+            evicted = self.strata[slot]
+            self.skipped.add(evicted)
+            self.reservoirs.pop(evicted)
+            self.strata[slot] = key
+        self.reservoirs[key] = [0, []]
+        return True
+
+    def add(self, photo):
+        key = self.stratum(photo)
+        if key in self.skipped:
+            return
+        if key not in self.reservoirs and self.__admit(key) == False:
+            return
+        reservoir = self.reservoirs[key]
+        reservoir[0] = reservoir[0] + 1
+        if len(reservoir[1]) < self.per_stratum:
+            reservoir[1].append(photo)
         else:
-            # Animal id seen previously, and we still need photos
-            output_photos.append(photo)
-    return output_photos
+            slot = self.rng.randrange(reservoir[0])
+            if slot < self.per_stratum:
+                reservoir[1][slot] = photo
+
+    def add_all(self, photos):
+        for photo in photos:
+            self.add(photo)
+        return self
+
+    def sample(self, limit=None):
+        """
+        Return the sampled photos, stratum by stratum. With a limit, return
+        a random subset of at most that many photos, in the same order.
+        """
+        photos = [photo for key in self.strata for photo in self.reservoirs[key][1]]
+        if limit != None and len(photos) > limit:
+            keep = sorted(self.rng.sample(range(len(photos)), limit))
+            photos = [photos[i] for i in keep]
+        return photos
+
+def define_min_photo_sample(min_count=40, photo_count=40, species=["1", "2"],
+                            rng=None, stratify="animal", max_age=None):
+    """
+    Fetch a sample of all animals that have at least N photos in the dataset.
+    Defaults to 40 photos. Each animal (or other stratum) contributes up to
+    photo_count photos.
+    """
+    sampler = StratifiedSampler(photo_count, None, STRATA[stratify], rng)
+    sampler.add_all(collect_photo_uris(min_count, species, None, max_age))
+    return sampler.sample()
 
-def fetch_sample_photos(folder, desired_photos, species, size):
+def define_random_tag_sample(num_animals, num_photos, species, taglist,
+                             rng=None, stratify="animal", max_age=None):
+    """
+    Fetch a random sample of the Red Panda Lineage project's linked photos,
+    with up to num_photos photos overall, from up to num_animals animals (or
+    other strata).
+    """
+    sampler = StratifiedSampler(num_photos, num_animals, STRATA[stratify], rng)
+    sampler.add_all(collect_photo_uris(0, species, taglist, max_age))
+    return sampler.sample(num_photos)
+
+def fetch_sample_photos(folder, desired_photos, species, size, workers=4):
     """
     Given a defined set of photos we selected from the dataset, grab them
-    from the Internet, and write them in an organized way.
+    from the Internet, and write them in an organized way. Photos already
+    in the folder are skipped, so an interrupted fetch can be picked up
+    again by running with the same folder.
 
     Structure of the output:
     ./sample-<utime>: output folder 
@@ -121,9 +258,10 @@ def fetch_sample_photos(folder, desired_photos, species, size):
     # Build the species output folders based on desired species values
     for specie in species:
         if (specie == "1"):
-            os.makedirs(folder + "/a.f.fulgens")
+            os.makedirs(folder + "/a.f.fulgens", exist_ok=True)
         if (specie == "2"):
-            os.makedirs(folder + "/a.f.styani")
+            os.makedirs(folder + "/a.f.styani", exist_ok=True)
+    downloads = []
     for photo in desired_photos:
         output_species = "a.f.fulgens"
         if photo.species == "2":
@@ -131,19 +269,17 @@ def fetch_sample_photos(folder, desired_photos, species, size):
         output_entity = photo.entity_id
         output_photo_index = photo.photo_index
         output_image = folder + "/" + output_species + "/" + output_entity + "_photo." + output_photo_index + ".jpg"
-        # Fetch an image
-        success = fetch_photo(photo.photo_uri, output_image, size)
-        if success:
-            random_sleep()
-        else:
-            while success == False:
-                print("Validate the URI/your Internet. Press ENTER to try again.")
-                choice = input("Or type \"continue\" to skip: ")
-                if choice == "continue":
-                    break
-                success = fetch_photo(photo.photo_uri, output_image, size)
+        downloads.append([photo.photo_uri, output_image, size])
+    # Fetch images, rate-limited per host, with retries for failures
+    fetcher = PhotoFetcher(workers=workers, token=os.getenv('OE_TOKEN', None))
+    failed = fetcher.fetch_all(downloads)
+    fetcher.close()
+    if len(failed) > 0:
+        print("%s photos failed to fetch. Run again with --folder %s to retry:" % (len(failed), folder))
+        for [photo_uri, output_image, _] in failed:
+            print("  %s -> %s" % (photo_uri, output_image))
 
-def write_sample_summary(folder, desired_photos):
+def write_sample_summary(folder, desired_photos, seed=None):
     """
     Write an informational summary of the sample, as well as all URLs gathered
     and the ownership data/commit info for each one.
@@ -152,6 +288,8 @@ def write_sample_summary(folder, desired_photos):
     ./sample-<utime>: output folder
     ./sample/info.txt: Record and summary of the queried photo data
         - RPF Git commit, sample.py command ran (including animal and photo counts)
+        - The random seed, so running the same command with --seed <seed>
+          on the same commit picks the same photos again
     """
     animal_count = str(len(set(map(lambda x: x.entity_id, desired_photos))))
     fulgens = list(filter(lambda x: x.species == "1", desired_photos))
@@ -165,6 +303,9 @@ def write_sample_summary(folder, desired_photos):
     output_metadata = folder + "/info.txt"
     with open(output_metadata, 'w') as wfh:
         # TODO: high-level data
+        wfh.write("sample.command: " + " ".join(sys.argv) + "\n")
+        if seed != None:
+            wfh.write("sample.seed: " + str(seed) + "\n")
         wfh.write("panda.count: " + animal_count)
         wfh.write("\npanda.fulgens.count: " + fulgens_count + "\n")
         for photo in fulgens:
@@ -182,11 +323,16 @@ def write_sample_summary(folder, desired_photos):
 if __name__ == '__main__':
     # Default settings
     animals = 100
+    folder = None
+    max_age = None
     min_photo_count = 0
     photo_count = 5
+    seed = random.SystemRandom().randrange(2 ** 32)
     size = "m"
     species = ["1", "2"]   # All Species
+    stratify = "animal"
     taglist = "close-up, profile, portrait"
+    workers = 4
     # Parse arguments
     if "--animals" in sys.argv:
         animals = int(sys.argv[sys.argv.index("--animals") + 1])
@@ -198,11 +344,21 @@ if __name__ == '__main__':
         if min_photo_count < 1:
             print("Candindate animal photo count must be positive.")
             sys.exit()
+    if "--folder" in sys.argv:
+        folder = sys.argv[sys.argv.index("--folder") + 1]
+    if "--max-age" in sys.argv:
+        max_age_days = int(sys.argv[sys.argv.index("--max-age") + 1])
+        if max_age_days < 0:
+            print("Max age in days can't be negative.")
+            sys.exit()
+        max_age = max_age_days * 24 * 60 * 60
     if "--photo-count" in sys.argv:
         photo_count = int(sys.argv[sys.argv.index("--photo-count") + 1])
         if photo_count < 1:
             print("Photo count must be positive.")
             sys.exit()
+    if "--seed" in sys.argv:
+        seed = int(sys.argv[sys.argv.index("--seed") + 1])
     if "--size" in sys.argv:
         size = sys.argv[sys.argv.index("--size") + 1]
         if ((size != "t") and (size != "m") and (size != "l")):
@@ -212,9 +368,25 @@ if __name__ == '__main__':
         if ((species < 1) or (species > 2)):
             raise SpeciesError("%s species value not 1 or 2 (1: fulgens, 2: styani)" % species)
         species = [str(species)]   # Treat like array of species values
+    if "--stratify" in sys.argv:
+        stratify = sys.argv[sys.argv.index("--stratify") + 1]
+        if stratify not in STRATA:
+            print("Stratify by one of: %s" % ", ".join(STRATA.keys()))
+            sys.exit()
     if "--taglist" in sys.argv:
         taglist = sys.argv[sys.argv.index("--taglist") + 1]
+    if "--workers" in sys.argv:
+        workers = int(sys.argv[sys.argv.index("--workers") + 1])
+        if workers < 1:
+            print("Workers count must be positive.")
+            sys.exit()
     taglist = taglist.split(", ")
+    # Run a query against the dataset, without building or fetching a sample
+    if "--query" in sys.argv:
+        if "--taglist" not in sys.argv:
+            taglist = None
+        print_photo_query(min_photo_count, species, taglist, max_age)
+        sys.exit()
     # The token isn't used here (it's in the fetch function) but if we check here,
     # we'll save time building a sample if we don't have all the necessary things to
     # fetch remote images.
@@ -223,20 +395,24 @@ if __name__ == '__main__':
         raise KeyError("Please set an OE_TOKEN environment variable for using the IG API")
     # Build a sample. If we do a min-photo-count sample set, then we ignore the
     # tag list to guarantee we have enough photos to work with.
+    rng = random.Random(seed)
     if (min_photo_count > 0):
-        photos = define_min_photo_sample(min_photo_count, photo_count, species)
+        photos = define_min_photo_sample(min_photo_count, photo_count, species,
+                                         rng, stratify, max_age)
     else:
-        photos = define_random_tag_sample(animals, photo_count, species, taglist)
+        photos = define_random_tag_sample(animals, photo_count, species, taglist,
+                                          rng, stratify, max_age)
     photo_count = str(len(photos))
     if photo_count == 0:
         print("Sample for your arguments contains no photos.")
         sys.exit()
     else:
         print("Sample for your arguments contains %s photos. Fetching..." % photo_count)
-    # Unique directory name (with current unixtime)
-    folder = "export/sample_" + str(current_time_to_unixtime())
-    os.makedirs(folder)
+    # Unique directory name (with current unixtime), unless resuming a fetch
+    if folder == None:
+        folder = "export/sample_" + str(current_time_to_unixtime())
+    os.makedirs(folder, exist_ok=True)
     # Write output information
-    write_sample_summary(folder, photos)
+    write_sample_summary(folder, photos, seed)
     # Start fetching photos
-    fetch_sample_photos(folder, photos, species, size)
+    fetch_sample_photos(folder, photos, species, size, workers)
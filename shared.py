@@ -1,5 +1,10 @@
+import array
+import calendar
 import configparser
 import datetime
+import functools
+import hashlib
+import io
 import json
 import os
 import sys
@@ -9,6 +14,7 @@ import time
 from collections import OrderedDict
 
 # Shared Python information for the Red Panda Lineage scripts
+INDEX_PATH = "./export/dataset-index.json"
 LINKS_PATH = "./links"
 MEDIA_PATH = "./media" 
 PANDA_PATH = "./pandas"
@@ -21,44 +27,116 @@ COMMIT_AGE = 7 * 24 * 60 * 60   # 7 days
 
 # IG alphabet for hashes, time ordering oldest to newest
 HASH_ORDER = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+HASH_VALUES = {char: value for value, char in enumerate(HASH_ORDER)}
 
-# Time conversion utility functions
+# Time conversion utility functions. Dates in the data files are written as
+# YYYY/MM/DD, and are converted to unixtime at 00:00 UTC, so the results
+# don't depend on the timezone or locale of the machine running the scripts.
 def current_date_to_unixtime():
     """
     Find the unixtime for today's date, at 00:00 hours, for the sake of
     doing one-week windows for new photo updates.
     """
-    now = datetime.datetime.now()
-    datestring = str(now.year) + "/" + str(now.month) + "/" + str(now.day)
-    return datetime_to_unixtime(datestring)
+    return calendar.timegm(datetime.date.today().timetuple())
 
 def current_time_to_unixtime():
-    return datetime.datetime.now().strftime("%s")
+    return int(time.time())
+
+@functools.lru_cache(maxsize=8192)
+def _commitdate_to_unixtime(commitdate):
+    [year, month, day] = commitdate.split("/")
+    # datetime.date rejects out-of-range days and months
+    date = datetime.date(int(year), int(month), int(day))
+    return calendar.timegm(date.timetuple())
 
 def datetime_to_unixtime(commitdate):
     """
     Take an arbitrary YYYY/MM/DD string and convert it to unixtime, for
     the purpose of determining if a photo was added to RPF during a specific
-    time window.
+    time window. Results are memoized, since a dataset only has a few
+    thousand distinct dates. Raises ValueError for malformed dates.
     """
     if commitdate == None:
         return current_date_to_unixtime()
-    return int(datetime.datetime.strptime(commitdate, '%Y/%m/%d').strftime("%s"))
+    return _commitdate_to_unixtime(commitdate.strip())
+
+def datetimes_to_unixtimes(commitdates):
+    """
+    Convert a list of YYYY/MM/DD strings to a compact array of 64-bit
+    unixtimes, in the same order. Missing dates become today's date.
+    """
+    return array.array("q", [datetime_to_unixtime(commitdate)
+                             for commitdate in commitdates])
+
+def within_commit_age(commitdate, age=COMMIT_AGE, now=None):
+    """
+    Check whether a YYYY/MM/DD date falls within the last `age` seconds,
+    counting from the start of today (or from the `now` unixtime).
+    """
+    if now == None:
+        now = current_date_to_unixtime()
+    return now - datetime_to_unixtime(commitdate) <= age
 
 # Other utility functions
+def hash_locator_key(photo_uri):
+    """
+    Decode the hash part of a cwdc:// or IG-style locator into a sort key,
+    using the HASH_ORDER alphabet. Shorter hashes sort first, and hashes of
+    the same length sort by their value as a base-64 number, which is the
+    oldest-to-newest time order. The file extension is ignored, since "."
+    isn't in the alphabet.
+    """
+    locator = photo_uri.split("/")[-1].split(".")[0]
+    value = 0
+    for char in locator:
+        value = value * 64 + HASH_VALUES[char]
+    return (len(locator), value)
+
 def get_max_entity_count():
     """
-    Read the export/redpanda.json file. If it doesn't exist, ask one to
-    be built. Then read _photo.entity_max from this file, which is the
-    highest photo count for a single panda or zoo.
+    Find _photo.entity_max, which is the highest photo count for a single
+    panda, zoo, media or wild file, from export/redpanda.json. If it hasn't
+    been built, count the photos in the data files through the dataset
+    index instead. Nothing in these scripts needs this any more, but it's
+    kept for outside callers.
     """
-    data = "export/redpanda.json"
-    if (os.path.exists(data)):
-        with open("export/redpanda.json", "r") as jfh:
+    if os.path.exists(OUTPUT_PATH):
+        with open(OUTPUT_PATH, "r", encoding="utf-8") as jfh:
             return json.loads(jfh.read())["_photo"]["entity_max"]
-    else:
-        print("%s file not built yet with build.py -- please generate.")
-        sys.exit()
+    counts = [record["photo_count"] for record in load_dataset_index().entries()]
+    return max(counts, default=0)
+
+def normalize_photo_uri(photo_uri):
+    """
+    Reduce a photo URI to a key that is the same for every spelling of the
+    same image, for finding duplicates:
+        ig://<shortcode>/<size>, ig://<author>/<shortcode>/<size>, and
+        https://www.instagram.com/[<author>/]p/<shortcode>/media/?size=<size>
+            => ig://<shortcode>/<size>
+        cwdc://<locator> => unchanged
+        http(s)://<Host>/<path>/ => https://<host>/<path>
+    The IG size stays in the key. Some media files deliberately list a large
+    copy of a photo next to the medium one, with its own location tags.
+    """
+    if photo_uri.startswith("cwdc://"):
+        return photo_uri
+    if photo_uri.startswith("ig://"):
+        parts = photo_uri[5:].split("/")
+        if len(parts) > 2:
+            parts = parts[1:]
+        return "ig://" + "/".join(parts)
+    [scheme, _, rest] = photo_uri.partition("://")
+    if scheme.lower() not in ["http", "https"]:
+        return photo_uri
+    [host, _, path] = rest.partition("/")
+    host = host.lower()
+    if host in ["instagram.com", "www.instagram.com"]:
+        parts = path.split("/")
+        if "p" in parts and parts.index("p") + 1 < len(parts):
+            shortcode = parts[parts.index("p") + 1]
+            [_, _, size] = path.partition("?size=")
+            return "ig://" + shortcode + ("/" + size if size else "")
+    return "https://" + host + "/" + path.rstrip("/")
 
 def random_sleep_jitter():
     return random.randint(15, 30)
@@ -187,6 +265,115 @@ class ProperlyDelimitedConfigParser(configparser.ConfigParser):
                 value = ""
             fp.write("{}{}\n".format(key, value))
 
+    def sort_options(self, key):
+        """Reorder the single data section's options before writing."""
+        self._defaults = OrderedDict(sorted(self._defaults.items(), key=key))
+
+class SectionParser():
+    """
+    A purpose-built reader/writer for panda/zoo/media/wild data files. These
+    files are always a single [section] of "key: value" lines, so rather than
+    running ConfigParser's regex-based line matching, interpolation setup and
+    default-section merging, we read them in a single linear pass into an
+    ordered dict.
+
+    The subset of the ConfigParser API that PhotoFile uses is supported, with
+    the same semantics: option names are lowercased, indented lines continue
+    the previous value, "%%" reads back as "%", and write() produces the
+    same bytes as ProperlyDelimitedConfigParser.write().
+    """
+    def __init__(self, default_section, delimiters=(':')):
+        self.default_section = default_section
+        self.file_section = default_section
+        self._delimiter = delimiters[0]
+        self._defaults = OrderedDict()
+
+    def read(self, file_path, encoding=None):
+        if not os.path.exists(file_path):
+            return []
+        with open(file_path, "r", encoding=encoding) as rfh:
+            self.read_string(rfh.read(), file_path)
+        return [file_path]
+
+    def read_string(self, string, source="<string>"):
+        items = self._defaults
+        option = None
+        option_indent = 0
+        for lineno, line in enumerate(string.splitlines(), start=1):
+            value = line.strip()
+            if not value:
+                if option != None:
+                    items[option].append("")
+                continue
+            if value[0] in "#;":
+                continue
+            indent = len(line) - len(line.lstrip())
+            if option != None and indent > option_indent:
+                items[option].append(value)
+                continue
+            if value[0] == "[" and value[-1] == "]":
+                self.file_section = value[1:-1]
+                option = None
+                continue
+            split = value.find(self._delimiter)
+            if split == -1:
+                raise configparser.ParsingError(source)
+            option = value[:split].strip().lower()
+            if option in items:
+                raise configparser.DuplicateOptionError(
+                    self.file_section, option, source, lineno)
+            items[option] = [value[split + 1:].strip()]
+            option_indent = indent
+        for option, lines in items.items():
+            if isinstance(lines, list):
+                items[option] = "\n".join(lines).rstrip()
+
+    def __check_section(self, section):
+        if section not in (self.default_section, self.file_section):
+            raise configparser.NoSectionError(section)
+
+    def has_option(self, section, option):
+        if section not in (self.default_section, self.file_section):
+            return False
+        return option.lower() in self._defaults
+
+    def get(self, section, option, raw=False):
+        self.__check_section(section)
+        try:
+            value = self._defaults[option.lower()]
+        except KeyError:
+            raise configparser.NoOptionError(option, section)
+        if raw:
+            return value
+        return value.replace("%%", "%")
+
+    def set(self, section, option, value):
+        self.__check_section(section)
+        if "%" in value.replace("%%", ""):
+            raise ValueError("invalid interpolation syntax in %r" % value)
+        self._defaults[option.lower()] = value
+
+    def remove_option(self, section, option):
+        self.__check_section(section)
+        return self._defaults.pop(option.lower(), None) != None
+
+    def options(self, section):
+        self.__check_section(section)
+        return list(self._defaults.keys())
+
+    def defaults(self):
+        return self._defaults
+
+    def sort_options(self, key):
+        """Reorder the single data section's options before writing."""
+        self._defaults = OrderedDict(sorted(self._defaults.items(), key=key))
+
+    def write(self, fp):
+        lines = ["[" + self.default_section + "]\n"]
+        for key, value in self._defaults.items():
+            lines.append(key + self._delimiter + " " + str(value).replace("\n", "\n\t") + "\n")
+        fp.write("".join(lines))
+
 class PhotoEntry:
     """
     Represents all properties of a photo entry in a file.
@@ -198,8 +385,17 @@ class PhotoEntry:
     The UpdateFromCommits class uses hash tables of these by 
     locator ID to make accurate counts of new photos, new entities, 
     and new contributors.
+
+    Samples can hold tens of thousands of these, so instances use slots
+    rather than a __dict__, and the values that repeat from photo to photo
+    (authors, dates, ids, species) are interned so equal values share one
+    string. The photo locator is only built when it's asked for.
     """
-    def __init__(self, filename, raw):
+    __slots__ = ["filename", "author_name", "commitdate", "entity_commitdate",
+                 "entity_id", "entity_type", "photo_index", "photo_uri",
+                 "species", "_photo_locator"]
+
+    def __init__(self, filename, raw, photo_file=None):
         self.filename = filename
         self.author_name = None
         self.commitdate = None
@@ -209,16 +405,23 @@ class PhotoEntry:
         self.photo_index = None
         self.photo_uri = None
         self.species = None
+        self._photo_locator = None
         # Read in the entity details from the backing file just once
-        self._read_update_entity_id(raw)
-    
+        self._read_update_entity_id(raw, photo_file)
+
+    @staticmethod
+    def _intern(value):
+        return None if value == None else sys.intern(value)
+
     def entity_locator(self):
         return self.entity_type + "." + self.entity_id
 
     def photo_locator(self):
-        return self.entity_locator() + ".photo." + self.photo_index
+        if self._photo_locator == None:
+            self._photo_locator = self.entity_locator() + ".photo." + self.photo_index
+        return self._photo_locator
 
-    def _read_update_entity_id(self, raw):
+    def _read_update_entity_id(self, raw, photo_file=None):
         """
         Open the config file and read its _id value.
         Store the entity_type and entity_id for each photo.
@@ -226,63 +429,51 @@ class PhotoEntry:
         Read the raw line and return a corresponding entity ID to track
         in one of the "media|panda|zoo" object tables. We're specifically
         looking for updates matching the form: "photo.X: url".
+
+        If the caller already parsed the backing file, pass it in as
+        photo_file. Otherwise, the file gets parsed here.
         """
         key = raw.split(":")[0]
         photo_uri = raw[len(key) + 1:].strip()
         photo_index = key.split(".")[1]
-        config = configparser.ConfigParser()
-        self.filename = "./" + self.filename   # Standardize path
-        if not os.path.exists(self.filename):
+        if self.filename.find("./") != 0:
+            self.filename = "./" + self.filename   # Standardize path
+        if self.filename.find(MEDIA_PATH) != -1:
+            section = "media"
+        elif self.filename.find(PANDA_PATH) != -1:
+            section = "panda"
+        elif self.filename.find(ZOO_PATH) != -1:
+            section = "zoo"
+        elif self.filename.find(WILD_PATH) != -1:
+            section = "wild"
+        else:
+            return
+        if photo_file == None and not os.path.exists(self.filename):
             # Fallback to filename number and path for entity
             # This is a hack for when files are renamed
-            if self.filename.find(MEDIA_PATH) != -1:
-                self.entity_type = "media"
-            elif self.filename.find(PANDA_PATH) != -1:
-                self.entity_type = "panda"
-            elif self.filename.find(ZOO_PATH) != -1:
-                self.entity_type = "zoo"
+            if section != "wild":
+                self.entity_type = self._intern(section)
             # Consider whole path, and remove leading zeroes from id
-            self.entity_id = self.filename.split("/").pop().split("_")[0].lstrip("0")
+            self.entity_id = self._intern(self.filename.split("/").pop().split("_")[0].lstrip("0"))
             # Other items will be entered as None
             return
-        # Set all values based on entity and photo info        
-        config.read(self.filename, encoding='utf-8')
-        if self.filename.find(MEDIA_PATH) != -1:
-            entity = config.get("media", "_id")
-            self.entity_type = entity.split(".")[0]
-            self.entity_id = entity[len(self.entity_type) + 1:]
-            self.entity_commitdate = config.get("media", "commitdate")
-            self.author_name = config.get("media", key + ".author")
-            self.commitdate = config.get("media", key + ".commitdate")
-            self.photo_index = photo_index
-            self.photo_uri = photo_uri
-        elif self.filename.find(PANDA_PATH) != -1:
-            self.entity_type = "panda"
-            self.entity_id = config.get("panda", "_id")
-            self.entity_commitdate = config.get("panda", "commitdate")
-            self.author_name = config.get("panda", key + ".author")
-            self.commitdate = config.get("panda", key + ".commitdate")
-            self.photo_index = photo_index
-            self.photo_uri = photo_uri
-            self.species = config.get("panda", "species")
-        elif self.filename.find(ZOO_PATH) != -1:
-            self.entity_type = "zoo"
-            self.entity_id = config.get("zoo", "_id")
-            self.entity_commitdate = config.get("zoo", "commitdate")
-            self.author_name = config.get("zoo", key + ".author")
-            self.commitdate = config.get("zoo", key + ".commitdate")
-            self.photo_index = photo_index
-            self.photo_uri = photo_uri
-        elif self.filename.find(WILD_PATH) != -1:
-            self.entity_type = "wild"
-            self.entity_id = config.get("wild", "_id")
-            self.entity_commitdate = config.get("wild", "commitdate")
-            self.author_name = config.get("wild", key + ".author")
-            self.commitdate = config.get("wild", key + ".commitdate")
-            self.photo_index = photo_index
-            self.photo_uri = photo_uri
+        # Set all values based on entity and photo info
+        if photo_file == None:
+            photo_file = PhotoFile(section, self.filename)
+        if section == "media":
+            entity = photo_file.get_field("_id")
+            self.entity_type = self._intern(entity.split(".")[0])
+            self.entity_id = self._intern(entity[len(self.entity_type) + 1:])
         else:
-            pass
+            self.entity_type = self._intern(section)
+            self.entity_id = self._intern(photo_file.get_field("_id"))
+        if section == "panda":
+            self.species = self._intern(photo_file.get_field("species"))
+        self.entity_commitdate = self._intern(photo_file.get_field("commitdate"))
+        self.author_name = self._intern(photo_file.get_field(key + ".author"))
+        self.commitdate = self._intern(photo_file.get_field(key + ".commitdate"))
+        self.photo_index = self._intern(photo_index)
+        self.photo_uri = photo_uri
 
 class PhotoFile():
     """
@@ -290,23 +481,104 @@ class PhotoFile():
     of these files, and support deletion operations. Since the ConfigParser API is
     a little bit clunky and since we have an object for dealing with these PhotoFiles
     anyways, wrap the ConfigParser primitives with easier-to-read sugar.
+
+    Photo fields are pulled out of the parser when the file is loaded, into a list
+    of photo records where slot 0 holds photo.1. Each record maps the rest of the
+    key (author, commitdate, link, tags, tags.<panda_id>.location) to its value,
+    with the photo URI itself under "". Deleted photos leave a None hole until the
+    list is compacted. Deleting, renumbering and reordering photos are all single
+    passes over this list, and the flat photo.N.* keys are only rebuilt by
+    update_file.
+
+    Edits mark the file as dirty, and update_file only writes when something
+    changed and the new contents hash differently from what was read in.
     """
-    def __init__(self, section, file_path):
+    def __init__(self, section, file_path, parser_class=SectionParser, contents=None):
         if section == None:
             raise SectionNameError("""Using wrong section ID to look for photos: %s""" % str(section))
 
         self.section = section
-        self.config = ProperlyDelimitedConfigParser(default_section=self.section, delimiters=(':'))
-        self.config.read(file_path, encoding="utf-8")
+        # Either SectionParser (fast) or ProperlyDelimitedConfigParser
+        self.config = parser_class(default_section=self.section, delimiters=(':'))
         self.file_path = file_path
+        self.content_hash = None
+        self.dirty = False
+        self.photos = []
+        # Callers can hand in file contents they already have, such as an
+        # older version of the file from git history
+        if contents == None and os.path.exists(file_path):
+            with open(file_path, "r", encoding="utf-8") as rfh:
+                contents = rfh.read()
+        if contents != None:
+            self.config.read_string(contents, file_path)
+            self.content_hash = self.__hash(contents)
+        self.__load_photos()
+
+    def __hash(self, contents):
+        return hashlib.sha1(contents.encode("utf-8")).hexdigest()
+
+    def __load_photos(self):
+        """
+        Move every photo.N.* option out of the parser and into photo records.
+        Values are kept raw, so "%%" escapes survive being moved around.
+        """
+        for option in list(self.config.defaults().keys()):
+            slot = self.__photo_slot(option)
+            if slot == None:
+                continue
+            [index, suffix] = slot
+            record = self.__photo_record(index, create=True)
+            record[suffix] = self.config.get(self.section, option, raw=True)
+            self.config.remove_option(self.section, option)
+
+    def __photo_slot(self, field_name):
+        """
+        Split a photo.N[.suffix] field name into a list slot and suffix, or
+        return None if it's not a photo field.
+        """
+        if field_name.find("photo.") != 0:
+            return None
+        [number, _, suffix] = field_name[6:].lower().partition(".")
+        if not number.isdigit() or int(number) < 1:
+            return None
+        return [int(number) - 1, suffix]
+
+    def __photo_record(self, index, create=False):
+        if index >= len(self.photos):
+            if create == False:
+                return None
+            self.photos.extend([None] * (index + 1 - len(self.photos)))
+        if self.photos[index] == None and create == True:
+            self.photos[index] = OrderedDict()
+        return self.photos[index]
+
+    def __get_raw(self, field_name):
+        slot = self.__photo_slot(field_name)
+        if slot == None:
+            return self.config.get(self.section, field_name, raw=True)
+        return self.__photo_record(slot[0])[slot[1]]
+
+    def __set_raw(self, field_name, value):
+        if self.has_field(field_name) and self.__get_raw(field_name) == value:
+            return
+        slot = self.__photo_slot(field_name)
+        if slot == None:
+            self.config.set(self.section, field_name, value)
+        else:
+            self.__photo_record(slot[0], create=True)[slot[1]] = value
+        self.dirty = True
 
     def has_field(self, field_name):
-        return self.config.has_option(self.section, field_name)
+        slot = self.__photo_slot(field_name)
+        if slot == None:
+            return self.config.has_option(self.section, field_name)
+        record = self.__photo_record(slot[0])
+        return record != None and slot[1] in record
 
     def field_equals_value(self, field_name, desired_value):
-        if self.config.has_option(self.section, field_name) == False:
+        if self.has_field(field_name) == False:
             return False
-        value = self.config.get(self.section, field_name)
+        value = self.get_field(field_name)
         if (value == desired_value):
             return True
 
@@ -316,7 +588,7 @@ class PhotoFile():
         return an array of values.
         """
         if self.has_field(field_name):
-            result = self.config.get(self.section, field_name)
+            result = self.get_field(field_name)
             if (result.find(", ") != -1):
                 return result.split(", ")
             else:
@@ -327,7 +599,7 @@ class PhotoFile():
         """
         Check something like the tags list for a particular tag value.
         """
-        if self.config.has_option(self.section, field_name) == False:
+        if self.has_field(field_name) == False:
             return False
         value_list = self.get_array(field_name)
         for desired_value in desired_values:
@@ -340,7 +612,7 @@ class PhotoFile():
         """
         Check that a panda tag list contains all values in a desired list
         """
-        if self.config.has_option(self.section, field_name) == False:
+        if self.has_field(field_name) == False:
             return False
         value_list = self.get_array(field_name)
         for desired_value in desired_values:
@@ -358,7 +630,8 @@ class PhotoFile():
         return [] so that other loops can iterate on an empty value.
         """
         if self.has_field(field_name):
-            return self.config.get(self.section, field_name)
+            # Same "%%" unescaping that ConfigParser.get does
+            return self.__get_raw(field_name).replace("%%", "%")
         else:
             return None
 
@@ -366,18 +639,16 @@ class PhotoFile():
         """
         Sugar around get_field, just for photos.
         """
-        photo_field = "photo." + photo_id
-        if self.has_field(photo_field):
-            return self.config.get(self.section, photo_field)
-        else:
-            return None
+        return self.get_field("photo." + str(photo_id))
 
     def set_field(self, field_name, value):
         """
         Set a value in the data file.
         """
         # print("DEBUG SET: " + str(field_name) + " -- " + str(value))
-        self.config.set(self.section, field_name, value)
+        if "%" in value.replace("%%", ""):
+            raise ValueError("invalid interpolation syntax in %r" % value)
+        self.__set_raw(field_name, value)
 
     def copy_field(self, dest_field, source_field):
         """
@@ -386,7 +657,7 @@ class PhotoFile():
         the field copied properly, or false otherwise.
         """
         if self.has_field(source_field) == True:
-            self.set_field(dest_field, self.get_field(source_field))
+            self.__set_raw(dest_field, self.__get_raw(source_field))
         return self.has_field(source_field)
 
     def delete_field(self, field_name):
@@ -394,8 +665,17 @@ class PhotoFile():
         Given a field name, and given the existence of that as a key-value pair in
         the data file, remove that field from the file.
         """
-        if self.has_field(field_name):
+        if self.has_field(field_name) == False:
+            return
+        self.dirty = True
+        slot = self.__photo_slot(field_name)
+        if slot == None:
             self.config.remove_option(self.section, field_name)
+            return
+        record = self.photos[slot[0]]
+        record.pop(slot[1])
+        if len(record) == 0:
+            self.photos[slot[0]] = None
 
     def move_field(self, dest_field, source_field):
         """
@@ -423,130 +703,371 @@ class PhotoFile():
     def update_file(self):
         """
         Write the config file out, in alphabetical sorted order just as they are read in.
+        The photo records are flattened back into photo.N.* fields here.
+
+        Nothing is written unless the file is dirty and its new contents differ
+        from what's on disk. Writes go to a temp file that is renamed over the
+        original, so readers never see a half-written file. Returns True if the
+        file was written.
         """
-        with open(self.file_path, 'w', encoding='utf-8') as wfh:
-            # Sort the sections before writing
-            self.config._defaults = OrderedDict(
-                sorted(self.config._defaults.items(), key=self.__strings_number_sensitive))
-            self.config.write(wfh)
+        if self.dirty == False:
+            return False
+        output = self.config.__class__(default_section=self.section, delimiters=(':'))
+        for option in self.config.defaults().keys():
+            output.set(self.section, option, self.config.get(self.section, option, raw=True))
+        for index, record in enumerate(self.photos):
+            if record == None:
+                continue
+            photo_option = "photo." + str(index + 1)
+            for suffix, value in record.items():
+                if suffix == "":
+                    output.set(self.section, photo_option, value)
+                else:
+                    output.set(self.section, photo_option + "." + suffix, value)
+        # Sort the sections before writing
+        output.sort_options(key=self.__strings_number_sensitive)
+        buffer = io.StringIO()
+        output.write(buffer)
+        contents = buffer.getvalue()
+        self.dirty = False
+        if self.__hash(contents) == self.content_hash:
+            return False
+        temp_path = self.file_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as wfh:
+            wfh.write(contents)
+        os.replace(temp_path, self.file_path)
+        self.content_hash = self.__hash(contents)
+        return True
 
     def delete_photo(self, index):
         """
         Given an index, delete a photo from the data file. 
         If the baseline photo.X field isn't found, then assume none of the other 
-        fields are defined and return False.
+        fields are defined and return False. Author, commitdate, link, tags, and
+        any group-photo location tags go along with the photo.
         """
         photo_option = "photo." + str(index)
         if self.has_field(photo_option) == False:
             return False
-        author_option = photo_option + ".author"
-        author_commitdate = photo_option + ".commitdate"
-        author_link = photo_option + ".link"
-        author_tags = photo_option + ".tags"
-        panda_tags = "panda.tags"
         print("deleting: " + self.file_path + " -- " + photo_option)
-        self.delete_field(photo_option)
-        self.delete_field(author_option)
-        self.delete_field(author_commitdate)
-        self.delete_field(author_link)
-        self.delete_field(author_tags)
-        # For location group-photo tag lines, look for the numbers in the tag section, 
-        # and remove any corresponding location tags from the groups section
-        for panda_id in self.get_array(panda_tags):
-            photo_location_tag = author_tags + "." + panda_id + ".location"
-            self.delete_field(photo_location_tag)
+        self.photos[int(index) - 1] = None
+        self.dirty = True
+        return True
+
+    def merge_photo(self, index, duplicate):
+        """
+        Fold the raw fields of a duplicate photo record into photo.X. Tags are
+        combined into one sorted list, the earlier commitdate wins, and any
+        other fields photo.X doesn't have yet (like group-photo location tags)
+        are copied over. The duplicate itself is left for the caller to delete.
+        """
+        record = self.__photo_record(int(index) - 1)
+        if record == None:
+            return False
+        for suffix, value in duplicate.items():
+            if suffix not in record:
+                record[suffix] = value
+            elif suffix == "tags":
+                tag_list = record["tags"].split(", ") + value.split(", ")
+                tags = ", ".join(sorted(dict.fromkeys(tag_list)))
+                if tags == record["tags"]:
+                    continue
+                record["tags"] = tags
+            elif suffix == "commitdate":
+                if (datetime_to_unixtime(value) >=
+                    datetime_to_unixtime(record["commitdate"])):
+                    continue
+                record["commitdate"] = value
+            else:
+                continue
+            self.dirty = True
         return True
 
     def photo_count(self):
         """
         Find the number of photos in this config file.
         """
-        photo_index = 1
-        photo_option = "photo." + str(photo_index)
-        is_photo = self.has_field(photo_option)
-        if is_photo == True:
-            while is_photo == True:
-                photo_index = photo_index + 1
-                photo_option = "photo." + str(photo_index)
-                is_photo = self.has_field(photo_option)
-        return photo_index - 1
-
-    def __fetch_next_photo_index(self, start_point, stop_point):
-        """
-        Given we deleted pandas from a dataset entry, find the first available hole in
-        the list of photos, and the next available photo to move into that hole.
-        """
-        photo_index = start_point
-        photo_option = "photo." + str(photo_index)
-        is_photo = self.has_field(photo_option)
-        if is_photo == True:
-            # Find the first hole (slot without a photo)
-            while is_photo == True:
-                photo_index = photo_index + 1
-                photo_option = "photo." + str(photo_index)
-                is_photo = self.has_field(photo_option)
-                if photo_index > stop_point:
-                    return 0
-        # Now that we're in holes, find the next valid photo
-        while is_photo == False:
-            photo_index = photo_index + 1
-            photo_option = "photo." + str(photo_index)
-            is_photo = self.has_field(photo_option)
-            # If start point went beyond the last photo, return zero
-            if photo_index > stop_point:
-                return 0
-        return photo_index
-
-    def renumber_photos(self, stop_point):
+        photo_count = 0
+        for record in self.photos:
+            if record == None or "" not in record:
+                break
+            photo_count = photo_count + 1
+        return photo_count
+
+    def renumber_photos(self, stop_point=None):
         """
         After a deletion operation, renumber all photos in the file so that
-        there are no gaps in the photo numbering.
-        """
-        start_index = 1
-        photo_index = start_index
-        while photo_index <= stop_point:
-            # If a photo doesn't exist, find the next photo that exists and swap its value
-            photo_option = "photo." + str(photo_index)
-            photo_author = photo_option + ".author"
-            photo_commitdate = photo_option + ".commitdate"
-            photo_link = photo_option + ".link"
-            photo_tags = photo_option + ".tags"
-            panda_tags = "panda.tags"
-            if self.has_field(photo_option) == False:
-                next_index = self.__fetch_next_photo_index(photo_index, stop_point)
-                next_option = "photo." + str(next_index)
-                next_author = next_option + ".author"
-                next_commitdate = next_option + ".commitdate"
-                next_link = next_option + ".link"
-                next_tags = next_option + ".tags"
-                if self.has_field(next_option) == True:
-                    self.move_field(photo_option, next_option)
-                    self.move_field(photo_author, next_author)
-                    self.move_field(photo_commitdate, next_commitdate)
-                    self.move_field(photo_link, next_link)
-                    self.move_field(photo_tags, next_tags)
-                    for panda_id in self.get_array(panda_tags):
-                        photo_location_tag = photo_tags + "." + panda_id + ".location"
-                        next_location_tag = next_tags + "." + panda_id + ".location"
-                        self.move_field(photo_location_tag, next_location_tag)
-            photo_index = photo_index + 1
+        there are no gaps in the photo numbering. The stop_point argument is
+        accepted for older callers, but the photo list already knows where
+        the photos end, so every gap gets closed.
+        """
+        if None in self.photos:
+            self.photos = [record for record in self.photos if record != None]
+            self.dirty = True
+
+    def sort_photos(self, key):
+        """
+        Renumber photos into the order given by a key function on each photo
+        record, closing any gaps. The sort is stable, so photos that have
+        equal keys keep their current relative order.
+        """
+        self.renumber_photos()
+        photos = sorted(self.photos, key=key)
+        if photos != self.photos:
+            self.photos = photos
+            self.dirty = True
             
     def remove_author(self, author):
         """
         Given all entries in a photo file with a matching author entry, remove those 
-        fields from the photos list.
+        fields from the photos list. Returns the number of photos removed.
         """
-        start_index = 1
         removals = 0
-        photo_index = start_index
-        author_option = "photo." + str(photo_index) + ".author"
-        while self.has_field(author_option):
-            photo_author = self.get_field(author_option)
-            if author == photo_author:
-                self.delete_photo(photo_index)
+        for index, record in enumerate(self.photos):
+            if record != None and record.get("author") == author:
+                self.delete_photo(index + 1)
                 removals = removals + 1
-            photo_index = photo_index + 1
-            author_option = "photo." + str(photo_index) + ".author"
         # Next, renumber the ones that are still there
         if removals > 0:
-            self.renumber_photos(photo_index)
+            self.renumber_photos()
+        return removals
+
+class DatasetIndex():
+    """
+    A persistent catalog of every panda/zoo/media/wild data file, so that the
+    scripts don't have to walk and parse the whole dataset before doing any
+    real work. For each file we track its entity id, mtime, size, photo count,
+    species, photo authors, photo URIs, and the tags on each photo.
+
+    The catalog is stored as JSON under export/. On refresh, only files whose
+    mtime or size changed since the last run are parsed again, and records for
+    deleted files are dropped. A no-op refresh is just a directory scan.
+    """
+    VERSION = 2
+    SECTIONS = OrderedDict([
+        (MEDIA_PATH, "media"),
+        (PANDA_PATH, "panda"),
+        (WILD_PATH, "wild"),
+        (ZOO_PATH, "zoo")
+    ])
+
+    def __init__(self, index_path=INDEX_PATH):
+        self.index_path = index_path
+        self.records = {}
+        self.changed = False
+        self.__load()
+
+    def __load(self):
+        """
+        Read the persisted catalog. If it's missing, corrupt, or from an older
+        version of this class, start from scratch and let refresh rebuild it.
+        """
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as rfh:
+                data = json.loads(rfh.read())
+        except ValueError:
+            return
+        if data.get("version") != self.VERSION:
+            return
+        self.records = data["records"]
+
+    def __scan(self, folder):
+        """
+        Yield (path, stat) for every data file under a folder. Paths use the
+        same "./pandas/<country>/<zoo>/<file>" form that os.walk produces.
+        """
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                path = folder + os.sep + entry.name
+                if entry.is_dir():
+                    yield from self.__scan(path)
+                elif entry.name.endswith(".txt"):
+                    yield path, entry.stat()
+
+    def __read_record(self, section, path, stat):
+        """
+        Parse a single data file and summarize it for the catalog.
+        """
+        photo_list = PhotoFile(section, path)
+        photo_count = photo_list.photo_count()
+        photos = []
+        tags = []
+        authors = set()
+        for photo_index in range(1, photo_count + 1):
+            photos.append(photo_list.get_photo(str(photo_index)))
+            tags.append(photo_list.get_array("photo." + str(photo_index) + ".tags"))
+            author = photo_list.get_field("photo." + str(photo_index) + ".author")
+            if author != None:
+                authors.add(author)
+        return {
+            "authors": sorted(authors),
+            "id": photo_list.get_field("_id"),
+            "mtime": stat.st_mtime_ns,
+            "path": path,
+            "photo_count": photo_count,
+            "photos": photos,
+            "section": section,
+            "size": stat.st_size,
+            "species": photo_list.get_field("species"),
+            "tags": tags
+        }
+
+    def refresh(self, sections=None):
+        """
+        Bring the catalog up to date with the files on disk, re-reading only
+        the files whose mtime or size differ from the stored record. With a
+        list of sections, only those sections' folders are scanned.
+        """
+        seen = set()
+        for folder, section in self.SECTIONS.items():
+            if sections != None and section not in sections:
+                continue
+            if not os.path.isdir(folder):
+                continue
+            for path, stat in self.__scan(folder):
+                seen.add(path)
+                record = self.records.get(path)
+                if (record != None and
+                    record["mtime"] == stat.st_mtime_ns and
+                    record["size"] == stat.st_size):
+                    continue
+                self.records[path] = self.__read_record(section, path, stat)
+                self.changed = True
+        for path in list(self.records.keys()):
+            if sections != None and self.records[path]["section"] not in sections:
+                continue
+            if path not in seen:
+                self.records.pop(path)
+                self.changed = True
+        return self
+
+    def save(self):
+        """
+        Write the catalog back out if anything changed. Write to a temp file
+        and rename, so an interrupted run never leaves a truncated index.
+        """
+        if self.changed == False:
+            return
+        folder = os.path.dirname(self.index_path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as wfh:
+            wfh.write(json.dumps({
+                "version": self.VERSION,
+                "records": self.records
+            }, ensure_ascii=False))
+        os.replace(temp_path, self.index_path)
+        self.changed = False
+
+    def entries(self, sections=None):
+        """
+        Return catalog records in path order, optionally limited to a list
+        of sections ("media", "panda", "wild", "zoo").
+        """
+        return [self.records[path] for path in sorted(self.records.keys())
+                if sections == None or self.records[path]["section"] in sections]
+
+    def entries_with_author(self, author, sections=None):
+        """
+        Return records for data files that credit an author for a photo.
+        """
+        return [record for record in self.entries(sections)
+                if author in record["authors"]]
+
+    def entries_with_duplicate_photos(self, sections=None):
+        """
+        Return records for data files that list a photo more than once, under
+        any spelling of its URI.
+        """
+        return [record for record in self.entries(sections)
+                if len(set(map(normalize_photo_uri, record["photos"]))) <
+                   len(record["photos"])]
+
+    def photo_uri_index(self, sections=None):
+        """
+        Map each normalized photo URI to the [path, photo_index] places it is
+        used, across every catalogued data file. This is built from the stored
+        records, so only files that changed since the last refresh get parsed.
+        """
+        uri_index = OrderedDict()
+        for record in self.entries(sections):
+            for photo_index, photo_uri in enumerate(record["photos"], start=1):
+                key = normalize_photo_uri(photo_uri)
+                uri_index.setdefault(key, []).append([record["path"], photo_index])
+        return uri_index
+
+    def duplicate_photo_uris(self, sections=None):
+        """
+        Return only the photo URI index entries used in more than one place.
+        """
+        return OrderedDict([(key, places) for key, places
+                            in self.photo_uri_index(sections).items()
+                            if len(places) > 1])
+
+def load_dataset_index(index_path=INDEX_PATH, sections=None):
+    """
+    Open the on-disk dataset index, refresh any stale records, and persist
+    the result for the next script run. Records outside of the sections
+    being refreshed are kept as-is, and may be out of date.
+    """
+    index = DatasetIndex(index_path).refresh(sections)
+    index.save()
+    return index
+
+class GitStager():
+    """
+    Collect the paths a script touched, and stage them with a handful of git
+    calls at the end, rather than spawning a `git add` process per file. Only
+    paths whose content differs from the git index (or that are new) are
+    staged. Paths go to git in fixed-size chunks, so that very large sweeps
+    don't run into command-line length limits.
+    """
+    CHUNK_SIZE = 500
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.paths = OrderedDict()
+
+    def add(self, path):
+        self.paths[os.path.normpath(path)] = True
+
+    def add_all(self, paths):
+        for path in paths:
+            self.add(path)
+
+    def __chunks(self, paths):
+        for start in range(0, len(paths), self.CHUNK_SIZE):
+            yield paths[start:start + self.CHUNK_SIZE]
+
+    def changed_paths(self):
+        """
+        Ask git which of the collected paths have unstaged or untracked
+        changes. Porcelain output lists each path as "XY <path>\0", and a
+        Y column other than a space means the worktree differs.
+        """
+        changed = []
+        for chunk in self.__chunks(list(self.paths.keys())):
+            status = self.repo.git.status(
+                "--porcelain", "-z", "--untracked-files=all", "--", *chunk)
+            entries = iter(status.split("\0"))
+            for entry in entries:
+                if len(entry) < 4:
+                    continue
+                if entry[0] in "RC":
+                    next(entries, None)   # Skip the rename's source path
+                if entry[1] != " ":
+                    changed.append(os.path.normpath(entry[3:]))
+        return changed
+
+    def stage(self):
+        """
+        Stage every collected path that changed, and return the staged paths.
+        """
+        changed = self.changed_paths()
+        for chunk in self.__chunks(changed):
+            self.repo.git.add("--", *chunk)
+        self.paths = OrderedDict()
+        return changed
@@ -20,23 +20,502 @@
 #    rsync, vim, xli
 #
 
-from shared import ProperlyDelimitedConfigParser, read_settings
+from shared import GitStager, PANDA_PATH, ProperlyDelimitedConfigParser, ZOO_PATH, load_dataset_index, read_settings
 from manage import sort_image_updates
 from PIL import Image
+from collections import OrderedDict
 from datetime import datetime
+import concurrent.futures
+import contextlib
 import git
+import glob
+import hashlib
+import io
 import json
 import os
+import queue
 import shlex
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 RESIZE_REGULAR = 400   # pixels
 RESIZE_GROUP = 800   # pixels
+RESIZE_CACHE = "./export/resize-cache"   # Resized photos, by source content
 PANDA_INDEX = {}
 ZOO_INDEX = {}
-MEDIA_INDEX = {}
-LOCATORS = []   # Don't process photos more than once
+LEDGER_NAME = "locators.jsonl"   # Journal of processed locators, in processed_folder
+
+class IdAllocator():
+    """
+    Hand out new panda or zoo IDs. The highest ID in use is tracked as a
+    number, so allocating doesn't sort the whole index (zero-padded strings
+    also stop sorting numerically past 9999). Just before an ID goes out,
+    every folder under data_path is checked for a file that already starts
+    with that ID, in case one was created since indexing.
+    """
+    def __init__(self, data_path):
+        self.data_path = data_path
+        self.max_id = 0
+        self.lock = threading.Lock()
+
+    def observe(self, id):
+        """Account for an ID that's already in use"""
+        if id.isdigit():   # Skip files not named like <id>_<name>.txt
+            self.max_id = max(self.max_id, int(id))
+
+    def __taken(self, new_id):
+        """Paths of any data files already named with this ID"""
+        pattern = os.path.join(self.data_path, "**", "{:04d}[_-]*.txt".format(new_id))
+        return glob.glob(pattern, recursive=True)
+
+    def allocate(self):
+        """Return the next unused ID, as a number"""
+        with self.lock:
+            new_id = self.max_id + 1
+            taken = self.__taken(new_id)
+            while len(taken) > 0:
+                print("ID {id} is already taken by {path}".format(id=new_id, path=taken[0]))
+                new_id = new_id + 1
+                taken = self.__taken(new_id)
+            self.max_id = new_id
+            return new_id
+
+class ImageResizer():
+    """
+    Resize and rotate contributed photos in a pool of worker processes, so that
+    the next contribution's photos are ready by the time the current one has
+    been reviewed. Photos are only queued once, and the time each one took is
+    kept for a summary at the end of the run. Used as a context manager, the
+    pool is shut down on the way out, and if that's because of an error, the
+    resizes that haven't started yet are cancelled.
+    """
+    def __init__(self, workers=None, cache_folder=RESIZE_CACHE):
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        self.cache_folder = cache_folder
+        self.futures = OrderedDict()   # photo path -> future
+
+    def submit(self, entity_file, photo_paths):
+        """Queue resizes for the photos of one metadata file"""
+        for [photo_path, aspect, orientation] in image_resize_jobs(entity_file, photo_paths):
+            if photo_path in self.futures:
+                continue
+            self.futures[photo_path] = self.executor.submit(
+                resize_and_rotate_image, photo_path, aspect, orientation,
+                self.cache_folder)
+
+    def wait(self, photo_paths):
+        """Block until the given photos are done being resized"""
+        for photo_path in photo_paths:
+            if photo_path in self.futures:
+                self.futures[photo_path].result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(cancel=exc_type != None)
+
+    def close(self, cancel=False):
+        self.executor.shutdown(wait=True, cancel_futures=cancel)
+
+    def print_summary(self):
+        """Print how long each photo took, and the totals"""
+        timings = [future.result() for future in self.futures.values()]
+        timings = [timing for timing in timings if timing != None]
+        if len(timings) == 0:
+            return
+        print("\nResized {count} images:".format(count=len(timings)))
+        for [photo_path, seconds, outcome] in timings:
+            print("  {seconds:6.3f}s  {outcome:7}  {path}".format(
+                seconds=seconds, outcome=outcome, path=photo_path))
+        total = sum([seconds for [_, seconds, _] in timings])
+        print("  {total:6.3f}s total, {mean:.3f}s mean, {most:.3f}s max".format(
+            total=total,
+            mean=total / len(timings),
+            most=max([seconds for [_, seconds, _] in timings])
+        ))
+        skipped = len([outcome for [_, _, outcome] in timings if outcome != "resized"])
+        print("  {skipped} served from the resize cache".format(skipped=skipped))
+
+class ImageUploader():
+    """
+    Put contributed photos on the image server in bounded chunks, a few
+    chunks at a time. Each chunk is one `rsync --files-from` transfer, and
+    every chunk shares one SSH ControlMaster connection, so the command
+    line doesn't grow with the batch and SSH only handshakes once. Photos
+    that make it are recorded as "uploaded" in the locator ledger, so a
+    rerun only sends what's missing, and failed chunks are retried as
+    smaller chunks of just their own photos.
+
+    With a blank image_hosting_server, the image_hosting_server_folder is
+    treated as a local directory, which is handy for testing.
+    """
+    def __init__(self, config, ledger, workers=4, chunk_size=100, retries=2):
+        self.server = config.get("submissions", "image_hosting_server", fallback="")
+        self.user = config.get("submissions", "image_hosting_user", fallback="")
+        self.destination_folder = config.get("submissions", "image_hosting_server_folder")
+        self.ledger = ledger
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.control_folder = tempfile.mkdtemp(prefix="rpl-upload-")
+        self.ssh_command = [
+            "ssh",
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPersist=120",
+            "-o", "ControlPath=" + os.path.join(self.control_folder, "%r@%h:%p")
+        ]
+
+    def __chunks(self, photo_paths, chunk_size):
+        """Group photos by their folder, since rsync lists are folder-relative"""
+        folders = OrderedDict()
+        for photo_path in photo_paths:
+            folders.setdefault(os.path.dirname(photo_path), []).append(photo_path)
+        for folder_paths in folders.values():
+            for start in range(0, len(folder_paths), chunk_size):
+                yield folder_paths[start:start + chunk_size]
+
+    def __copy_local(self, chunk):
+        """Copy a chunk into a local destination folder, returning failures"""
+        failed = []
+        for photo_path in chunk:
+            destination = os.path.join(self.destination_folder, os.path.basename(photo_path))
+            temp_path = destination + ".part"
+            try:
+                os.makedirs(self.destination_folder, exist_ok=True)
+                shutil.copyfile(photo_path, temp_path)
+                os.replace(temp_path, destination)
+            except OSError as e:
+                print("upload failed: {path}: {error}".format(path=photo_path, error=e))
+                failed.append(photo_path)
+        return failed
+
+    def __rsync(self, chunk):
+        """Send a chunk with one rsync call, returning failures"""
+        folder = os.path.dirname(chunk[0])
+        with tempfile.NamedTemporaryFile("w", suffix=".files", encoding="utf-8") as wfh:
+            wfh.write("\n".join([os.path.basename(p) for p in chunk]) + "\n")
+            wfh.flush()
+            rsync_command = [
+                "rsync", "-t", "--partial",
+                "--files-from=" + wfh.name,
+                "-e", " ".join([shlex.quote(arg) for arg in self.ssh_command]),
+                (folder or ".") + "/",
+                "{user}@{server}:{destination_folder}/".format(
+                    user=self.user,
+                    server=self.server,
+                    destination_folder=self.destination_folder)
+            ]
+            result = subprocess.run(rsync_command)
+        if result.returncode != 0:
+            print("upload failed: rsync exited {code} for {count} photos in {folder}".format(
+                code=result.returncode, count=len(chunk), folder=folder))
+            return chunk
+        return []
+
+    def __transfer(self, chunk):
+        if self.server == "":
+            failed = self.__copy_local(chunk)
+        else:
+            failed = self.__rsync(chunk)
+        failed_paths = set(failed)
+        for photo_path in chunk:
+            if photo_path not in failed_paths:
+                self.ledger.record("uploaded", os.path.basename(photo_path))
+        return failed
+
+    def upload(self, photo_paths):
+        """
+        Upload every photo that isn't already on the server, and return
+        the set of photo paths that still failed after retries.
+        """
+        # Keyed by path, so duplicates drop out in constant time, in order
+        pending = OrderedDict()
+        for photo_path in photo_paths:
+            if self.ledger.has("uploaded", os.path.basename(photo_path)):
+                continue
+            pending[photo_path] = True
+        pending = list(pending)
+        chunk_size = self.chunk_size
+        for attempt in range(0, self.retries + 1):
+            if len(pending) == 0:
+                break
+            if attempt > 0:
+                print("Retrying {count} failed uploads...".format(count=len(pending)))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+                chunks = list(self.__chunks(pending, chunk_size))
+                pending = flatten_comprehension(executor.map(self.__transfer, chunks))
+            chunk_size = max(1, chunk_size // 10)
+        return set(pending)
+
+    def close(self):
+        """Stop the shared SSH connection, if one got started"""
+        if self.server != "":
+            subprocess.run(self.ssh_command + [
+                "-O", "exit", "{user}@{server}".format(user=self.user, server=self.server)],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(self.control_folder, ignore_errors=True)
+
+class LocatorLedger():
+    """
+    Keep track of which contributed photo locators and metadata files have
+    been handled. Within a run, claim() makes sure a photo listed by both a
+    panda and a photo metadata file only gets processed once. Across runs,
+    an append-only journal in the processed folder records each finished
+    stage (like "merged"), one JSON object per line, so that a run that
+    crashed halfway can be resumed without repeating that work. Lookups
+    are set and dict based, so they take constant time.
+    """
+    def __init__(self):
+        self.claimed = set()
+        self.entries = {}   # (stage, item) -> journal entry
+        self.journal_path = None
+        self.lock = threading.Lock()   # Uploads record from several threads
+
+    def open(self, journal_path):
+        """Replay a journal, and append to it from now on"""
+        self.journal_path = journal_path
+        if not os.path.exists(journal_path):
+            return self
+        with open(journal_path, "r", encoding="utf-8") as rfh:
+            for line in rfh:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue   # A line cut short by a crash
+                self.entries[(entry["stage"], entry["item"])] = entry
+        return self
+
+    def claim(self, locator):
+        """Returns False if this run already claimed the locator"""
+        if locator in self.claimed:
+            return False
+        self.claimed.add(locator)
+        return True
+
+    def get(self, stage, item):
+        return self.entries.get((stage, item))
+
+    def has(self, stage, item):
+        return (stage, item) in self.entries
+
+    def record(self, stage, item, **details):
+        """Mark a stage as done for an item, and flush it to the journal"""
+        entry = OrderedDict([("item", item), ("stage", stage)])
+        entry.update(details)
+        with self.lock:
+            self.entries[(stage, item)] = entry
+            if self.journal_path == None:
+                return
+            folder = os.path.dirname(self.journal_path)
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+            with open(self.journal_path, "a", encoding="utf-8") as wfh:
+                wfh.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                wfh.flush()
+                os.fsync(wfh.fileno())
+
+class MediaIndex():
+    """
+    Map media IDs to their files. Media IDs only live inside the files, so
+    unlike pandas and zoos they can't be read off a directory listing. The
+    mapping comes from the dataset index, which only re-parses media files
+    whose mtime or size changed, and it isn't loaded until the first lookup,
+    so batches without any media photos never touch the media tree.
+    """
+    def __init__(self):
+        self.paths = None
+        self.lock = threading.Lock()
+
+    def __load(self):
+        with self.lock:
+            if self.paths == None:
+                index = load_dataset_index(sections=["media"])
+                self.paths = dict([[record["id"], record["path"]]
+                                   for record in index.entries(["media"])])
+        return self.paths
+
+    def __contains__(self, id):
+        return id in self.__load()
+
+    def __getitem__(self, id):
+        return self.__load()[id]
+
+class MergeTarget():
+    """
+    A panda, zoo, or media file that contributed photos get merged into.
+    It's parsed once, with its IG locators mapped to their photo indexes
+    and the next free photo slot worked out in the same pass, so placing
+    each incoming photo is a dict lookup rather than a probe through
+    photo.1, photo.2, and so on.
+    """
+    def __init__(self, path, section, data=None):
+        self.path = path
+        self.section = section
+        if data == None:
+            data = ProperlyDelimitedConfigParser(default_section=section, delimiters=(':'))
+            data.read(path)
+        self.data = data
+        self.ig_locators = {}   # IG locator -> photo index
+        self.indexes = set()
+        for key in data[section]:
+            [prefix, _, index] = key.partition(".")
+            if prefix != "photo" or not index.isdigit():
+                continue
+            self.indexes.add(int(index))
+            link = data.get(section, key)
+            if 'ig://' in link:
+                self.ig_locators.setdefault(link.split("/")[2], int(index))
+        self.next_index = 1
+        while self.next_index in self.indexes:
+            self.next_index = self.next_index + 1
+
+    def find(self, ig_locator=None):
+        """The photo index with an IG locator, or else the next free one"""
+        if ig_locator and ig_locator in self.ig_locators:
+            return self.ig_locators[ig_locator]
+        return self.next_index
+
+    def claim(self, ig_locator=None):
+        """Like find, but the photo index returned is about to be written,
+        so it's no longer free, or no longer has that IG locator"""
+        if ig_locator and ig_locator in self.ig_locators:
+            return self.ig_locators.pop(ig_locator)
+        index = self.next_index
+        self.indexes.add(index)
+        while self.next_index in self.indexes:
+            self.next_index = self.next_index + 1
+        return index
+
+    def write(self):
+        with open(self.path, "w") as wfh:
+            self.data.write(wfh)
+
+class SubmissionBranch():
+    """
+    Merge reviewed submission data into files on a new repo branch, one
+    result at a time, and commit everything together at the end. Metadata
+    files that an earlier run already merged (according to the ledger)
+    aren't merged twice, but still get committed if that never happened.
+
+    Photos are merged into MergeTargets that are kept for the whole batch,
+    so each panda, zoo, or media file is parsed once and written once at
+    commit time, however many photos it gets.
+    """
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self.messages = []
+        self.changed = []
+        self.targets = OrderedDict()   # path -> MergeTarget
+        self.pending = []   # photo merges to record once their file is written
+        self.resumed = OrderedDict()   # merged by an earlier run: path -> messages
+        self.repo = git.Repo(".")
+        if self.repo.active_branch.name == "master":
+            branchName = 'submissions-{timestamp}'.format(
+                timestamp=int(datetime.now().timestamp())
+            )
+            # Open the Git repo and set to a new branch
+            newBranch = self.repo.create_head(branchName)
+            self.repo.head.reference = newBranch
+            print("Starting new branch off of master: " + branchName)
+
+    def merge(self, result):
+        item = os.path.basename(result["config"])
+        merged = self.ledger.get("merged", item)
+        if merged != None:
+            self.resumed.setdefault(os.path.normpath(merged["config"]), []).append(merged["message"])
+            return
+        merge = merge_configuration(result, self.targets)
+        if merge == None:
+            return
+        # Add changed content to the commit
+        message = '+{locator}: {path}'.format(
+            locator=merge["locator"],
+            path=os.path.basename(merge["config"])
+        )
+        self.messages.append(message)
+        self.changed.append(merge["config"])
+        if merge["type"] == "photo":
+            self.pending.append([item, merge["config"], message])
+        else:
+            self.ledger.record("merged", item, config=merge["config"], message=message)
+
+    def commit(self):
+        """Write the merged photo files, then stage all files that were
+        changed, and commit them"""
+        try:
+            for target in self.targets.values():
+                target.write()
+            for [item, config, message] in self.pending:
+                self.ledger.record("merged", item, config=config, message=message)
+            stager = GitStager(self.repo)
+            stager.add_all(self.changed)
+            stager.add_all(self.resumed.keys())
+            staged = stager.stage()
+            for path in staged:
+                self.messages.extend(self.resumed.get(path, []))
+        finally:
+            composite = "\n".join(self.messages)
+            self.repo.index.commit(composite)
+            self.repo.close()
+
+class SubmissionPipeline():
+    """
+    Upload and merge approved results on a background thread, in the order
+    they were approved, while the operator carries on reviewing. A result
+    whose photos don't all make it to the image server is held back rather
+    than merged.
+    """
+    def __init__(self, uploader, branch):
+        self.uploader = uploader
+        self.branch = branch
+        self.held_back = []
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def __run(self):
+        while True:
+            result = self.queue.get()
+            if result == None:
+                return
+            if self.error != None:
+                continue   # Something broke, so just drain the queue
+            try:
+                failed = self.uploader.upload(result["photos"])
+                if len(failed) > 0:
+                    print("Holding back {path}: photos failed to upload".format(
+                        path=result["config"]))
+                    self.held_back.append(result)
+                    continue
+                self.branch.merge(result)
+            except Exception as e:
+                print("Stopped uploading and merging at {path}: {error}".format(
+                    path=result["config"], error=e))
+                self.error = e
+
+    def approve(self, result):
+        """Queue a result that the operator decided to keep"""
+        self.queue.put(result)
+
+    def finish(self):
+        """Wait for the queued results, and return the ones held back. If
+        uploading or merging broke, that error is left in self.error, so
+        the caller can clean up and commit what was merged before raising
+        it."""
+        self.queue.put(None)
+        self.thread.join()
+        return self.held_back
+
+LOCATORS = LocatorLedger()   # Don't process photos more than once
+MEDIA_INDEX = MediaIndex()
+PANDA_IDS = IdAllocator(PANDA_PATH)   # Next new panda ID
+ZOO_IDS = IdAllocator(ZOO_PATH)   # Next new zoo ID
 
 def convert_configparser_minus_blacklist(in_data, out_data, section, blacklist):
     for option in in_data.options(section):
@@ -187,24 +666,6 @@ def copy_across_configs(in_data, in_section, in_key, out_data, out_section, out_
         in_data.get(in_section, in_key)
     )
 
-def copy_images_to_image_server(results):
-    """Use scp to put photo files on an image server"""
-    photo_paths = flatten_comprehension([p["photos"] for p in results])
-    quoted_paths = [shlex.quote(p) for p in photo_paths]
-    server = config.get("submissions", "image_hosting_server")
-    destination_folder = config.get("submissions", "image_hosting_server_folder")
-    user = config.get("submissions", "image_hosting_user")
-    scp_command = 'scp {quoted_paths} {user}@{server}:{destination_folder}'.format(
-        quoted_paths=" ".join(quoted_paths),
-        user=user,
-        server=server,
-        destination_folder=destination_folder
-    )
-    print("\nCopying images to image server...")
-    result = os.system(scp_command)
-    if result != 0:
-        sys.exit(result)
-
 def copy_review_data_from_submissions_server(config):
     """Use rsync to grab data from the redpanda-submission server"""
     server = config.get("submissions", "contributions_server")
@@ -221,51 +682,6 @@ def copy_review_data_from_submissions_server(config):
         sys.exit(result)
     delete_empty_submission_dirs(processing_folder)
 
-def count_until_next_photo(config, section):
-    index = 1
-    while True:
-      try:
-          config.get(section, 'photo.{index}'.format(index=index))
-          index = index + 1
-          continue
-      except:
-          return index
-
-def create_submissions_branch(results):
-    """Merge all submission data into files on a new repo branch"""
-    try:
-        repo = git.Repo(".")
-        currentTime = datetime.now()
-        if repo.active_branch.name == "master":
-            branchName = 'submissions-{timestamp}'.format(
-                timestamp=int(currentTime.timestamp())
-            )
-            # Open the Git repo and set to a new branch
-            newBranch = repo.create_head(branchName)
-            repo.head.reference = newBranch
-            print("Starting new branch off of master: " + branchName)
-        messages = []
-        changed = []
-        # Process the results
-        for result in results:
-            merge = merge_configuration(result)
-            if merge == None:
-                continue
-            # Add changed content to the commit
-            message = '+{locator}: {path}'.format(
-                locator=merge["locator"],
-                path=os.path.basename(merge["config"])
-            )
-            messages.append(message)
-            changed.append(merge["config"])
-        # Add all files that were changed
-        for path in set(changed):
-            repo.git.add(path)
-    finally:
-        composite = "\n".join(messages)
-        repo.index.commit(composite)
-        repo.close()
-
 def delete_empty_submission_dirs(processing_folder):
     contributions = []
     for _, submission in enumerate(os.listdir(processing_folder)):
@@ -292,99 +708,101 @@ def flatten_comprehension(matrix):
     return [item for row in matrix for item in row]
 
 def find_instagram_locator(config, section, locator):
-    if not locator:   # Locator is empty string
-        return count_until_next_photo(config, section)
-    # Look at all photo indexes by their IG locators
-    index = 1
-    while True:
-      try:
-          link = config.get(section, 'photo.{index}'.format(index=index))
-          if 'ig://' in link:
-              link_locator = link.split("/")[2]
-              if locator == link_locator:
-                  return index
-          index = index + 1
-          continue
-      except:
-          return index
-
+    """The index of the photo with an IG locator, or the next free index"""
+    return MergeTarget(None, section, config).find(locator)
 
 def get_image_locators(contribution_path, metadata_path, metadata_file):
     """Given metadata, return the relevant image locators as full paths"""
-    metadata = json.loads(metadata_file)
-    locators = metadata.get("photo_locators")
-    if locators == None:   # Photo metadata file minus .json
-        locators = [".".join(os.path.basename(metadata_path).split(".")[0:2])]
     photo_paths = []
-    for locator in locators:
+    for photo_path in get_image_paths(contribution_path, metadata_path, metadata_file):
+        locator = os.path.basename(photo_path)
         # Pandas and photos have duplicate metadata, but only process one.
-        if locator in LOCATORS:
+        if LOCATORS.claim(locator) == False:
             continue
-        LOCATORS.append(locator)
-        photo_paths.append(os.path.join(contribution_path, locator))
+        photo_paths.append(photo_path)
     return photo_paths
 
+def get_image_paths(contribution_path, metadata_path, metadata_file):
+    """Given metadata, return the paths of all images it lists"""
+    metadata = json.loads(metadata_file)
+    locators = metadata.get("photo_locators")
+    if locators == None:   # Photo metadata file minus .json
+        locators = [".".join(os.path.basename(metadata_path).split(".")[0:2])]
+    return [os.path.join(contribution_path, locator) for locator in locators]
+
+def image_resize_jobs(entity_file, photo_paths):
+    """Decide the target size and orientation for each photo of a metadata
+    file. Returns a list of [photo path, aspect, orientation]."""
+    metadata = json.loads(entity_file)
+    # Only photo uploads have _id
+    if "_id" not in metadata:
+        return []
+    if metadata["_id"].find("media.") == 0:
+        aspect = RESIZE_GROUP
+    else:
+        aspect = RESIZE_REGULAR
+    orientation = metadata.get("orientation")
+    return [[photo_path, aspect, orientation] for photo_path in photo_paths]
+
 def index_zoos_and_animals():
-    """Index each four-digit ID (or media ID) by folder path"""
-    for _, country in enumerate(os.listdir("./pandas")):
-        country_path = os.path.join("./pandas", country)
-        for _, zoo in enumerate(os.listdir(country_path)):
-            zoo_path = os.path.join(country_path, zoo)
-            for _, panda in enumerate(os.listdir(zoo_path)):
-                panda_path = os.path.join(zoo_path, panda)
-                id = os.path.basename(panda_path).split("_")[0]
-                PANDA_INDEX[id] = panda_path
-    for _, country in enumerate(os.listdir("./zoos")):
-        country_path = os.path.join("./zoos", country)
-        for _, zoo in enumerate(os.listdir(country_path)):
-            zoo_path = os.path.join(country_path, zoo)
-            id = os.path.basename(zoo_path).split("_")[0]
-            ZOO_INDEX[id] = zoo_path
-    for _, country in enumerate(os.listdir("./media")):
-        country_path = os.path.join("./media", country)
-        for _, zoo in enumerate(os.listdir(country_path)):
-            zoo_path = os.path.join(country_path, zoo)
-            for _, media in enumerate(os.listdir(zoo_path)):
-                media_path = os.path.join(zoo_path, media)
-                # We have to read the configs to get proper media IDs
-                config = ProperlyDelimitedConfigParser()
-                config.read(media_path)
-                id = config.get("media", "_id")
-                MEDIA_INDEX[id] = media_path
-
-def iterate_through_contributions(processing_path):
-    """Look at pandas, zoos, and then individual photos in each contribution"""
+    """Index each four-digit ID by file path, from the file names alone.
+    Media IDs are indexed on first lookup, by MEDIA_INDEX."""
+    def scan(folder):
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                path = folder + os.sep + entry.name
+                if entry.is_dir():
+                    yield from scan(path)
+                elif entry.name.endswith(".txt"):
+                    yield path, entry.name.split("_")[0]
+    for path, id in scan(PANDA_PATH):
+        PANDA_INDEX[id] = path
+        PANDA_IDS.observe(id)
+    for path, id in scan(ZOO_PATH):
+        ZOO_INDEX[id] = path
+        ZOO_IDS.observe(id)
+
+def iterate_through_contributions(processing_path, resizer=None, pipeline=None):
+    """Look at pandas, zoos, and then individual photos in each contribution.
+    With a resizer, every contribution's photos are queued for resizing up
+    front, so they get resized in the background while earlier ones are
+    being reviewed. With a pipeline, each kept result is handed off to be
+    uploaded and merged as soon as it's been reviewed."""
     results = []
+    contributions = []
     for _, subfolder in enumerate(sorted(os.listdir(processing_path))):
         contribution_path = os.path.join(processing_path, subfolder)
         if (os.path.isfile(contribution_path)):
           continue
-        processed = []
-        for _, subfile in enumerate(sorted(os.listdir(contribution_path))):
-            contribution_file = os.path.join(contribution_path, subfile)
-            if ".panda.json" in contribution_file:
-                result = process_entity(contribution_path, contribution_file, "panda")
-                processed.append(contribution_file)
-                if result["status"] == "keep":
-                  results.append(result)
-        for _, subfile in enumerate(sorted(os.listdir(contribution_path))):
-            contribution_file = os.path.join(contribution_path, subfile)
-            if ".zoo.json" in contribution_file:
-                result = process_entity(contribution_path, contribution_file, "zoo")
-                processed.append(contribution_file)
-                if result["status"] == "keep":
-                  results.append(result)
-        for _, subfile in enumerate(sorted(os.listdir(contribution_path))):
-            contribution_file = os.path.join(contribution_path, subfile)
-            if ".json" in contribution_file and contribution_file not in processed:
-                result = process_entity(contribution_path, contribution_file, "photo")
-                processed.append(contribution_file)
-                if result["status"] == "keep":
-                  results.append(result)
+        contributions.append(contribution_path)
+    if resizer != None:
+        claimed = set(LOCATORS.claimed)
+        for contribution_path in contributions:
+            prefetch_contribution_images(resizer, contribution_path, claimed)
+    for contribution_path in contributions:
+        for [entity_path, entity_type] in list_contribution_entities(contribution_path):
+            result = process_entity(contribution_path, entity_path, entity_type, resizer)
+            if result["status"] == "keep":
+              results.append(result)
+              if pipeline != None:
+                  pipeline.approve(result)
     return results
 
-def merge_configuration(result):
-    """Make a commit for each metadata file in lexicographic order"""
+def list_contribution_entities(contribution_path):
+    """List a contribution's metadata files in review order: pandas, zoos,
+    and then individual photos"""
+    subfiles = [os.path.join(contribution_path, subfile)
+                for subfile in sorted(os.listdir(contribution_path))]
+    pandas = [[path, "panda"] for path in subfiles if ".panda.json" in path]
+    zoos = [[path, "zoo"] for path in subfiles if ".zoo.json" in path]
+    photos = [[path, "photo"] for path in subfiles if ".json" in path
+              and ".panda.json" not in path and ".zoo.json" not in path]
+    return pandas + zoos + photos
+
+def merge_configuration(result, targets=None):
+    """Make a commit for each metadata file in lexicographic order. Photos
+    are merged into a MergeTarget from targets, if given, and are left for
+    the caller to write. Otherwise the photo's file is written right away."""
     def get_panda_output_file_from_zoo_data(zoo_id, panda_id, en_name):
         zoo_path = ZOO_INDEX[zoo_id]
         panda_country = zoo_path.split("/")[2]
@@ -399,12 +817,12 @@ def merge_configuration(result):
     in_data = ProperlyDelimitedConfigParser()
     in_data.read(result["config"])
     if in_data.has_section("panda"):
-        new_panda_id = int(sorted(PANDA_INDEX.keys()).pop()) + 1
-        panda_check_id = '{:04d}'.format(abs(new_panda_id))
         zoo_id = int(in_data.get("panda", "zoo"))
         zoo_check_id = '{:04d}'.format(abs(zoo_id))
         # pandas have to have an en.name to determine their output file
         name = in_data.get("panda", "en.name")
+        new_panda_id = PANDA_IDS.allocate()
+        panda_check_id = '{:04d}'.format(abs(new_panda_id))
         # use the zoo id to determine the output folder
         out_path = get_panda_output_file_from_zoo_data(zoo_check_id, panda_check_id, name)
         PANDA_INDEX[panda_check_id] = out_path
@@ -412,7 +830,7 @@ def merge_configuration(result):
         # some values we want based on temp fields or our own checks
         out_data.set("panda", "_id", str(new_panda_id))
         convert_configparser_minus_blacklist(in_data, out_data, "panda", ["_id", "_notes"])
-        with open(out_path, "w") as wfh:
+        with open(out_path, "x") as wfh:
             out_data.write(wfh)
         return {
             "config": out_path,
@@ -421,7 +839,7 @@ def merge_configuration(result):
         }
     elif in_data.has_section("zoo"):
         # fill in some of this data from admin forms
-        new_zoo_id = int(sorted(ZOO_INDEX.keys()).pop()) + 1
+        new_zoo_id = ZOO_IDS.allocate()
         check_id = '{:04d}'.format(abs(new_zoo_id))
         out_path = "./zoos/{country}/{id}_{filename}.txt".format(
             country=in_data.get("zoo", "country.folder"),
@@ -437,7 +855,7 @@ def merge_configuration(result):
         convert_configparser_minus_blacklist(in_data, out_data, "zoo", [
             "_id", "_zoofilename", "country.name", "country.folder"
         ])
-        with open(out_path, "w") as wfh:
+        with open(out_path, "x") as wfh:
             out_data.write(wfh)
         return {
             "config": out_path,
@@ -467,9 +885,13 @@ def merge_configuration(result):
                 section = "zoo"
             check_id = '{:04d}'.format(abs(id_number))   # Up to three leading zeroes
         out_path = index[check_id]
-        out_data = ProperlyDelimitedConfigParser(default_section=section, delimiters=(':'))
-        out_data.read(out_path)
-        out_photo_count = find_instagram_locator(out_data, section, ig_locator)
+        target = targets.get(out_path) if targets != None else None
+        if target == None:
+            target = MergeTarget(out_path, section)
+            if targets != None:
+                targets[out_path] = target
+        out_data = target.data
+        out_photo_count = target.claim(ig_locator)
         in_photo_count = 1
         # Add or swap the photo
         in_photo_key = 'photo.{index}'.format(index=in_photo_count)
@@ -506,8 +928,8 @@ def merge_configuration(result):
             if len(tag_set) > 0:
                 out_data.set(section, out_photo_tags, ', '.join(tag_set))
         # TODO: media panda location tags
-        with open(out_path, "w") as wfh:
-            out_data.write(wfh)
+        if targets == None:
+            target.write()
         return {
             "config": out_path,
             "locator": out_data.get(section, out_photo_key),
@@ -516,17 +938,39 @@ def merge_configuration(result):
     else:
         return None
     
-def migrate_submissions_to_submitted():
+def migrate_submissions_to_submitted(held_back=[]):
+    """Move processed contributions out of the processing folder, except
+       for the ones with results being held back for the next run"""
     processing_folder = config.get("submissions", "processing_folder")
     processed_folder = config.get("submissions", "processed_folder")
+    held_folders = set([os.path.dirname(result["config"]) for result in held_back])
     for _, submission in enumerate(os.listdir(processing_folder)):
         submission_path = os.path.join(processing_folder, submission)
+        if submission_path in held_folders:
+            continue
         # submissions are all folders
         if os.path.isdir(submission_path):
             submission_path = os.path.join(processing_folder, submission)
             processed_path = os.path.join(processed_folder, submission)
             os.renames(submission_path, processed_path)
  
+def prefetch_contribution_images(resizer, contribution_path, claimed):
+    """Queue image resizes for a contribution ahead of its review. This skips
+    the same metadata files and already-claimed locators that process_entity
+    will, so no photo gets resized that wouldn't have been anyways. Locators
+    queued here are added to the claimed set."""
+    for [entity_path, entity_type] in list_contribution_entities(contribution_path):
+        if os.path.exists(entity_path.replace(".json", ".txt")):
+            continue
+        with open(entity_path, "r") as rfh:
+            entity_file = rfh.read()
+        photo_paths = []
+        for photo_path in get_image_paths(contribution_path, entity_path, entity_file):
+            if os.path.basename(photo_path) not in claimed:
+                claimed.add(os.path.basename(photo_path))
+                photo_paths.append(photo_path)
+        resizer.submit(entity_file, photo_paths)
+
 def print_configfile_contents(config_path):
     """Display the config file path and its contents, with a divider in-between"""
     print()
@@ -536,7 +980,7 @@ def print_configfile_contents(config_path):
         print(cfh.read())
     # TODO: print notes as a separate field from the entity, if notes exist
 
-def process_entity(contribution_path, entity_path, entity_type):
+def process_entity(contribution_path, entity_path, entity_type, resizer=None):
     """Show a metadata file converted from json into configparser format, and
     load a carousel of its (resized) images.
     
@@ -566,7 +1010,11 @@ def process_entity(contribution_path, entity_path, entity_type):
             }
         convert_json_to_configparser(entity_path, entity_file)
         print_configfile_contents(config_path)
-        resize_and_rotate_images(entity_file, photo_paths)
+        if resizer != None:
+            resizer.submit(entity_file, photo_paths)
+            resizer.wait(photo_paths)
+        else:
+            resize_and_rotate_images(entity_file, photo_paths)
         xli = display_images(photo_paths)
         decision = prompt_for_decision()
         if decision == "c":
@@ -628,86 +1076,127 @@ def read_existing_entity_for_photo(in_data):
     existing_data.read(existing_file)
     return existing_data
 
-def resize_and_rotate_images(entity_file, photo_paths):
+def reorient_image(image, orientation):
+    """Flip or rotate to correct, based on exifr JS dictionary values"""
+    if orientation == None or orientation == 'Horizontal (normal)':
+        return image
+    if orientation == 'Rotate 90 CW':
+        return image.transpose(Image.ROTATE_270)
+    elif orientation == 'Rotate 180':
+        return image.transpose(Image.ROTATE_180)
+    elif orientation == 'Rotate 270 CW':
+        return image.transpose(Image.ROTATE_90)
+    elif orientation == 'Mirror horizontal':
+        return image.transpose(Image.FLIP_LEFT_RIGHT)
+    elif orientation == 'Mirror vertical':
+        return image.transpose(Image.FLIP_TOP_BOTTOM)
+    elif orientation == 'Mirror horizontal and rotate 270 CW':
+        flip = image.transpose(Image.FLIP_LEFT_RIGHT)
+        return flip.transpose(Image.ROTATE_90)
+    elif orientation == 'Mirror horizontal and rotate 90 CW':
+        flip = image.transpose(Image.FLIP_LEFT_RIGHT)
+        return flip.transpose(Image.ROTATE_270)
+    else:
+        return image
+
+def resize_and_rotate_image(photo_path, aspect, orientation, cache_folder=None):
+    """Resize one image to the given aspect size (400px or 800px) in its
+       largest dimension, and rotate it. JPEGs are decoded at a reduced scale
+       when they're much bigger than needed, and the final downscale uses a
+       Lanczos filter. EXIF data isn't carried over to the output.
+
+       With a cache folder, resized outputs are kept by the hash of the source
+       image plus the aspect and orientation, so the same upload never gets
+       decoded and resized twice. Hashes of the outputs are remembered too,
+       so a photo that was already resized in place (by an interrupted run)
+       is left alone rather than being shrunk and rotated again.
+
+       Returns [photo path, seconds taken, "resized" | "cached" | "done"],
+       or None if the file is gone."""
+    # Files may get deleted prior to resizing
+    if not os.path.exists(photo_path):
+        return None
+    start = time.perf_counter()
+    with open(photo_path, "rb") as rfh:
+        contents = rfh.read()
+    if cache_folder != None:
+        content_hash = hashlib.sha1(contents).hexdigest()
+        done_path = os.path.join(cache_folder, "done", content_hash)
+        if os.path.exists(done_path):
+            return [photo_path, time.perf_counter() - start, "done"]
+        key = "{hash}:{aspect}:{orientation}".format(
+            hash=content_hash, aspect=aspect, orientation=orientation)
+        cache_path = os.path.join(cache_folder, hashlib.sha1(key.encode("utf-8")).hexdigest())
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as rfh:
+                write_resized_image(photo_path, rfh.read())
+            return [photo_path, time.perf_counter() - start, "cached"]
+    with Image.open(io.BytesIO(contents)) as source:
+        image_format = source.format
+        # Decoding with draft() picks the smallest JPEG scale that still
+        # covers the aspect size, so it never drops below the final size
+        source.draft(source.mode, (aspect, aspect))
+        image = reorient_image(source, orientation)
+        image.thumbnail((aspect, aspect), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, format=image_format)
+    resized = output.getvalue()
+    if cache_folder != None:
+        write_resized_image(cache_path, resized)
+        write_resized_image(os.path.join(cache_folder, "done",
+                                         hashlib.sha1(resized).hexdigest()), b"")
+    write_resized_image(photo_path, resized)
+    return [photo_path, time.perf_counter() - start, "resized"]
+
+def resize_and_rotate_images(entity_file, photo_paths, cache_folder=RESIZE_CACHE):
     """Resizes all images to 400px or 800px in the largest dimension, and
        determines how to rotate them based on metadata that was parsed out
        of EXIF tags in the frontend."""
-    def reorient_image(image, orientation):
-        """Flip or rotate to correct, based on exifr JS dictionary values"""
-        if orientation == None or orientation == 'Horizontal (normal)':
-            return image
-        if orientation == 'Rotate 90 CW':
-            return image.transpose(Image.ROTATE_270)
-        elif orientation == 'Rotate 180':
-            return image.transpose(Image.ROTATE_180)
-        elif orientation == 'Rotate 270 CW':
-            return image.transpose(Image.ROTATE_90)
-        elif orientation == 'Mirror horizontal':
-            return image.transpose(Image.FLIP_LEFT_RIGHT)
-        elif orientation == 'Mirror vertical':
-            return image.transpose(Image.FLIP_TOP_BOTTOM)
-        elif orientation == 'Mirror horizontal and rotate 270 CW':
-            flip = image.transpose(Image.FLIP_LEFT_RIGHT)
-            return flip.transpose(Image.ROTATE_90)
-        elif orientation == 'Mirror horizontal and rotate 90 CW':
-            flip = image.transpose(Image.FLIP_LEFT_RIGHT)
-            return flip.transpose(Image.ROTATE_270)
-        else:
-            return image
-    def resize_image(image, aspect):
-        """Resize image to the given aspect size (400px or 800px)"""
-        if image.size[0] > aspect or image.size[1] > aspect:
-            ratios = [image.size[0] / aspect, image.size[1] / aspect]
-            resize = [1, 1]
-            # If either side is larger than aspect, the ratio will be greater
-            # than one. Whichever ratio is the largest, we want to scale both
-            # dimensions by that amount.
-            if ratios[0] > 1:
-                resize[0] = ratios[0]
-            if ratios[1] > 1:
-                resize[1] = ratios[1]
-            if resize[0] > resize[1]:
-                resize[1] = resize[0]
-            else:
-                resize[0] = resize[1]
-            resolution = [
-                int(image.size[0] / resize[0]), 
-                int(image.size[1] / resize[1])
-            ]
-            resized = image.resize(resolution)
-            return resized
-        else:
-            return image
-    metadata = json.loads(entity_file)
-    # Only photo uploads have _id
-    if "_id" not in metadata:
-        return
-    if metadata["_id"].find("media.") == 0:
-        aspect = RESIZE_GROUP
-    else:
-        aspect = RESIZE_REGULAR
-    for photo_path in photo_paths:
-        # Files may get deleted prior to resizing
-        if not os.path.exists(photo_path):
-            continue
-        image = Image.open(photo_path)
-        if metadata.get("orientation"):
-          image = reorient_image(image, metadata["orientation"])
-        image = resize_image(image, aspect)
-        image.save(photo_path)
+    for [photo_path, aspect, orientation] in image_resize_jobs(entity_file, photo_paths):
+        resize_and_rotate_image(photo_path, aspect, orientation, cache_folder)
+
+def write_resized_image(path, contents):
+    """Write image bytes through a temp file, so readers (and other resize
+       workers) never see a partial image"""
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder, exist_ok=True)
+    temp_path = "{path}.{pid}.tmp".format(path=path, pid=os.getpid())
+    with open(temp_path, "wb") as wfh:
+        wfh.write(contents)
+    os.replace(temp_path, path)
 
 if __name__ == '__main__':
     index_zoos_and_animals()
     config = read_settings()
     processing_folder = config.get("submissions", "processing_folder")
+    processed_folder = config.get("submissions", "processed_folder")
+    LOCATORS.open(os.path.join(processed_folder, LEDGER_NAME))
     if len(sys.argv) == 1:
         copy_review_data_from_submissions_server(config)
     if len(sys.argv) == 2:
         if sys.argv[1] != "--local":
             copy_review_data_from_submissions_server(config)
-    results = iterate_through_contributions(processing_folder)
-    copy_images_to_image_server(results)
-    create_submissions_branch(results)
+    # Photos are resized ahead of review, and kept results are uploaded and
+    # merged behind it, so a batch takes about as long as reviewing it does.
+    # Results whose photos aren't on the image server don't get committed.
+    # Their contributions stay in the processing folder for a --local rerun.
+    uploader = ImageUploader(config, LOCATORS)
+    branch = SubmissionBranch(LOCATORS)
+    pipeline = SubmissionPipeline(uploader, branch)
+    # Cleanup runs in reverse order of being added (finish the pipeline,
+    # stop resizing, close the uploader, commit), and every step runs even
+    # if an earlier one fails
+    with contextlib.ExitStack() as cleanup:
+        cleanup.callback(branch.commit)
+        cleanup.callback(uploader.close)
+        resizer = cleanup.enter_context(ImageResizer())
+        cleanup.callback(pipeline.finish)
+        iterate_through_contributions(processing_folder, resizer, pipeline)
+    if pipeline.error != None:
+        raise pipeline.error
+    held_back = pipeline.held_back
+    resizer.print_summary()
     sort_image_updates()
-    migrate_submissions_to_submitted()
+    migrate_submissions_to_submitted(held_back)
     print("Please merge submissions to master when ready.")
@@ -0,0 +1,68 @@
+import http.server
+import threading
+
+import pytest
+
+from fetch import PhotoFetcher
+
+PHOTO = b"0123456789"
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serve PHOTO, honoring (and rejecting) range requests like a real host"""
+    def do_GET(self):
+        offset = 0
+        if self.headers.get("Range") != None:
+            offset = int(self.headers["Range"].split("=")[1].rstrip("-"))
+        if offset >= len(PHOTO):
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%s" % len(PHOTO))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(206 if offset > 0 else 200)
+        self.send_header("Content-Length", str(len(PHOTO) - offset))
+        self.end_headers()
+        self.wfile.write(PHOTO[offset:])
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def photo_url():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield "http://127.0.0.1:%s/photo.jpg" % server.server_address[1]
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+def test_complete_part_file_is_kept(tmp_path, photo_url):
+    """A 416 for a .part that's already the full size finishes the download"""
+    output_path = str(tmp_path / "photo.jpg")
+    with open(output_path + ".part", "wb") as wfh:
+        wfh.write(PHOTO)
+    fetcher = PhotoFetcher(retries=0)
+    assert fetcher.fetch(photo_url, output_path) == True
+    with open(output_path, "rb") as rfh:
+        assert rfh.read() == PHOTO
+    assert not (tmp_path / "photo.jpg.part").exists()
+
+def test_oversized_part_file_is_fetched_again(tmp_path, photo_url):
+    """A 416 for a .part larger than the photo starts over without a range"""
+    output_path = str(tmp_path / "photo.jpg")
+    with open(output_path + ".part", "wb") as wfh:
+        wfh.write(b"garbage" + PHOTO)
+    fetcher = PhotoFetcher(retries=0)
+    assert fetcher.fetch(photo_url, output_path) == True
+    with open(output_path, "rb") as rfh:
+        assert rfh.read() == PHOTO
+
+def test_partial_part_file_resumes(tmp_path, photo_url):
+    output_path = str(tmp_path / "photo.jpg")
+    with open(output_path + ".part", "wb") as wfh:
+        wfh.write(PHOTO[:4])
+    fetcher = PhotoFetcher(retries=0)
+    assert fetcher.fetch(photo_url, output_path) == True
+    with open(output_path, "rb") as rfh:
+        assert rfh.read() == PHOTO
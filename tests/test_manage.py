@@ -0,0 +1,84 @@
+import git
+import os
+
+from manage import AUTHOR_REMOVALS_PATH, AuthorRemovalIndex, remove_author_from_lineage, restore_photos_to_lineage
+
+PANDA_FILE = """[panda]
+_id: 1
+en.name: A
+photo.1: ig://AAA/m
+photo.1.author: yy
+photo.1.commitdate: 2020/1/1
+species: 1
+"""
+
+def make_repo(folder):
+    """A small dataset repo with one panda file, committed"""
+    os.makedirs(os.path.join(folder, "pandas", "japan", "0001_zoo"))
+    with open(os.path.join(folder, "pandas", "japan", "0001_zoo", "0001_a.txt"), "w") as wfh:
+        wfh.write(PANDA_FILE)
+    repo = git.Repo.init(folder)
+    with repo.config_writer() as config:
+        config.set_value("user", "name", "test")
+        config.set_value("user", "email", "test@example.com")
+    repo.git.add("-A")
+    repo.index.commit("init")
+    return repo
+
+def test_restore_into_missing_path(tmp_path, monkeypatch, capsys):
+    """Photos for a file that's gone get listed, and the rest get restored"""
+    repo = make_repo(str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    restore_photos_to_lineage(repo, "xx", {
+        "pandas/japan/0001_zoo/0001_a.txt": {
+            "photo.2": "ig://BBB/m",
+            "photo.2.author": "xx"
+        },
+        "pandas/japan/0001_zoo/0002_moved.txt": {
+            "photo.4": "ig://CCC/m",
+            "photo.4.author": "xx",
+            "photo.4.commitdate": "2020/1/3"
+        }
+    })
+    output = capsys.readouterr().out
+    assert "0002_moved.txt:\nfile no longer exists" in output
+    assert "photo.4: ig://CCC/m" in output
+    assert "photo.4.commitdate: 2020/1/3" in output
+    with open("pandas/japan/0001_zoo/0001_a.txt", "r") as rfh:
+        assert "photo.2: ig://BBB/m" in rfh.read()
+    assert repo.head.commit.message == "+author: xx"
+
+def test_removal_index_only_indexes_author_removals(tmp_path, monkeypatch):
+    """Photos dropped by other commits aren't author removals"""
+    repo = make_repo(str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    path = "pandas/japan/0001_zoo/0001_a.txt"
+    with open(path, "a") as wfh:
+        wfh.write("photo.2: ig://BBB/m\nphoto.2.author: xx\nphoto.2.commitdate: 2020/1/2\n"
+                  "photo.3: ig://CCC/m\nphoto.3.author: xx\nphoto.3.commitdate: 2020/1/3\n")
+    repo.git.add(path)
+    repo.index.commit("+xx")
+    remove_author_from_lineage("xx")
+    removal = repo.head.commit.hexsha
+    # Swap yy's photo to a cwdc:// locator, which drops its ig:// URI
+    with open(path, "r") as rfh:
+        contents = rfh.read().replace("ig://AAA/m", "cwdc://WxxLPqoADQA.jpg")
+    with open(path, "w") as wfh:
+        wfh.write(contents)
+    repo.git.add(path)
+    repo.index.commit("+WxxLPqoADQA: 0001_a.txt")
+    index = AuthorRemovalIndex(repo).update()
+    assert index.lookup("yy") == []
+    [entry] = index.lookup("xx")
+    assert entry["commit"] == removal
+    assert entry["photos"] == {
+        "photo.2": "ig://BBB/m",
+        "photo.2.author": "xx",
+        "photo.2.commitdate": "2020/1/2",
+        "photo.3": "ig://CCC/m",
+        "photo.3.author": "xx",
+        "photo.3.commitdate": "2020/1/3"
+    }
+    # Rebuilding from history finds the same removal
+    os.remove(AUTHOR_REMOVALS_PATH)
+    assert AuthorRemovalIndex(repo).update().lookup("xx") == [entry]
@@ -0,0 +1,36 @@
+import datetime
+import os
+
+from sample import collect_photo_uris, define_random_tag_sample
+from shared import current_date_to_unixtime
+
+def commitdate(unixtime):
+    return datetime.datetime.fromtimestamp(unixtime, datetime.timezone.utc).strftime("%Y/%m/%d")
+
+def write_panda(folder, dates):
+    """A panda file with one photo per commitdate given"""
+    lines = ["[panda]", "_id: 1", "en.name: A"]
+    for index, date in enumerate(dates):
+        option = "photo." + str(index + 1)
+        lines.append(option + ": ig://P" + str(index) + "/m")
+        lines.append(option + ".author: xx")
+        lines.append(option + ".commitdate: " + date)
+    lines.append("species: 1")
+    os.makedirs(os.path.join(folder, "pandas", "japan", "0001_zoo"))
+    with open(os.path.join(folder, "pandas", "japan", "0001_zoo", "0001_a.txt"), "w") as wfh:
+        wfh.write("\n".join(lines) + "\n")
+
+def test_max_age_keeps_recent_photos(tmp_path, monkeypatch):
+    """Only photos committed within max_age seconds are collected"""
+    day = 24 * 60 * 60
+    today = current_date_to_unixtime()
+    write_panda(str(tmp_path), [commitdate(today - 30 * day),
+                                commitdate(today - 2 * day),
+                                commitdate(today)])
+    monkeypatch.chdir(tmp_path)
+    photos = collect_photo_uris(max_age=7 * day)
+    assert [photo.photo_uri for photo in photos] == ["ig://P1/m", "ig://P2/m"]
+    photos = collect_photo_uris()
+    assert len(list(photos)) == 3
+    photos = define_random_tag_sample(10, 10, ["1", "2"], None, max_age=day)
+    assert [photo.photo_uri for photo in photos] == ["ig://P2/m"]
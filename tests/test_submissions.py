@@ -0,0 +1,15 @@
+import os
+
+from submissions import IdAllocator
+
+def test_allocate_skips_ids_taken_anywhere(tmp_path):
+    """An ID in use in any folder, even one the index missed, is skipped"""
+    for path in ["japan/0001_zoo/0005_a.txt", "china/0002_zoo/0006_b.txt",
+                 "china/0002_zoo/0008_c.txt"]:
+        os.makedirs(os.path.dirname(str(tmp_path / path)), exist_ok=True)
+        with open(str(tmp_path / path), "w") as wfh:
+            wfh.write("[panda]\n")
+    ids = IdAllocator(str(tmp_path))
+    ids.observe("0004")
+    assert ids.allocate() == 7
+    assert ids.allocate() == 9